@@ -0,0 +1,25 @@
+/*
+    Batch entry point for the native shared libraries (bin/*.so), used by NativeRunner.encrypt_batch
+
+    Encrypts the same message and associated data under n keys (and nonces), so that key candidates can be
+    verified with a single call from Python instead of one call per candidate.
+
+    A stride of 0 uses the same nonce (or key) for all the encryptions.
+*/
+
+#include "crypto_aead.h"
+
+void crypto_aead_encrypt_batch(
+	unsigned char *c, unsigned long long c_stride,
+	const unsigned char *m, unsigned long long mlen,
+	const unsigned char *ad, unsigned long long adlen,
+	const unsigned char *npub, unsigned long long npub_stride,
+	const unsigned char *k, unsigned long long k_stride,
+	unsigned long long n
+) {
+	unsigned long long clen;
+
+	for (unsigned long long i = 0; i < n; ++i) {
+		crypto_aead_encrypt(c + i * c_stride, &clen, m, mlen, ad, adlen, 0, npub + i * npub_stride, k + i * k_stride);
+	}
+}
@@ -1,12 +1,16 @@
-import itertools
+import math
 import random
-import lascar
+import numpy as np
 from lascar import TraceBatchContainer
 from util import constants
+from util.cpa import BinnedCpaEngine, EarlyStopping, run_engines
+from util.enumeration import enumerate_keys
+from util.values import as_values
 
 from . import init_wrap
 from ..elephant_generic.capture import capture_traces
-from runners.native import NativeRunner
+from runners.native import native_runner
+from runners.parallel import shared_verifier
 from util.file_utils import *
 from .classifiers import *
 
@@ -14,22 +18,25 @@ BLOCK_SIZE = 20
 
 def _get_top_keys(results, keep_N=1):
     possible_keys = []
+    scores = []
     for index, r in enumerate(results):
-        possible_keys.append(abs(r).max(1).argsort()[::-1][:keep_N])
-    return possible_keys
+        r_max = abs(r).max(1)
+        possible_keys.append(r_max.argsort()[::-1][:keep_N])
+        scores.append(r_max[possible_keys[-1]])
+    return possible_keys, scores
 
 
-def _run_cpa(captured):
-    eng = [
-        lascar.CpaEngine(f'cpa{byte}', lambda ad, guess, index=byte: classifier_ad(index, ad, guess), range(256))
+def _cpa_engines():
+    return [
+        BinnedCpaEngine(f'cpa{byte}', lambda values, index=byte: values['ad'][:, index], classifier_ad_table(byte))
         for byte in range(BLOCK_SIZE)
     ]
 
-    lascar.Session(captured, engines=eng).run(batch_size="auto")
-    results = [engine.finalize() for engine in eng]
 
-    possible_keys = _get_top_keys(results, keep_N=8)
-    return possible_keys
+def _run_cpa(captured):
+    results = run_engines(captured, _cpa_engines())
+
+    return _get_top_keys(results, keep_N=8)
 
 
 # For tests only
@@ -39,7 +46,7 @@ def _expected_mask(key):
 # End for tests only
 
 
-def inverse_verify_key(mask, pt=None, nonce=None, ct=None):
+def inverse_verify_key(mask, pt=None, nonce=None, ct=None, runner=None):
     mask = mask_lfsr_goback(mask)
     key = spongent_inverse(mask)
 
@@ -50,7 +57,7 @@ def inverse_verify_key(mask, pt=None, nonce=None, ct=None):
             # pt-ct pair given, verify key
             print()
             print("[-] Found potential key", key.hex(), " -- verifying")
-            patch_runner = NativeRunner("bin/elephant160-patch.so")
+            patch_runner = runner if runner is not None else native_runner("bin/elephant160-patch.so")
             res = patch_runner.encrypt(key, pt, nonce)
 
             if res != ct:
@@ -62,34 +69,39 @@ def inverse_verify_key(mask, pt=None, nonce=None, ct=None):
     return None
 
 
-def exhaustive_search(pt, nonce, ct, mask):
-    it_count = 0  # for benchmarking purposes
+def _verify_masks(runner, masks, pt, nonce, ct):
+    """
+    Checks a chunk of masks on a worker of the verifier: the keys of all the masks are computed at once, and only the
+    ones that end with zeros are verified
+    """
+    states = np.frombuffer(b''.join(masks), np.uint8).reshape(len(masks), -1)
+    keys = spongent_inverse_batch(mask_lfsr_goback_batch(states))
 
-    print("[-] Running exhaustive search...")
+    for index in np.flatnonzero(~keys[:, 16:].any(axis=1)):
+        if inverse_verify_key(masks[index], pt, nonce, ct, runner) is not None:
+            return int(index)
+    return None
 
-    for n_errors in range(4):
-        # which byte will we check
-        print("[-] Trying with", n_errors, "wrong bytes...")
-        wrong_bytes_combinations = itertools.combinations(range(BLOCK_SIZE), n_errors)
 
-        for wrong_bytes in wrong_bytes_combinations:
-            possible_values = itertools.product(*[mask[i] if i in wrong_bytes else [mask[i][0]] for i in range(BLOCK_SIZE)])
+def exhaustive_search(pt, nonce, ct, mask, mask_scores, max_errors=3):
+    # test as many candidates as there are masks with at most max_errors wrong bytes, by decreasing correlation
+    limit = sum(math.comb(BLOCK_SIZE, k) * (len(mask[0]) - 1) ** k for k in range(max_errors + 1))
+    print("[-] Running exhaustive search on the", limit, "most likely masks...")
 
-            for value in possible_values:
-                key = inverse_verify_key(bytes(value), pt, nonce, ct)
-                it_count += 1
+    # the native library is only needed to verify the keys against a pt-ct pair
+    verifier = shared_verifier("bin/elephant160-patch.so" if ct is not None else None)
+    masks = (bytes(value) for value in enumerate_keys(mask, mask_scores, limit=limit))
+    found, it_count = verifier.search(masks, _verify_masks, pt, nonce, ct, chunk_size=4096)
 
-                if key is not None:
-                    print()
-                    return key, it_count
+    if found is not None:
+        return inverse_verify_key(found), it_count
 
-        print()
     # print("This exhaustive search of the key space will never terminate, don't worry.")
     # print("If you see this message, the universe has probably ended and the key way very wrong.")
     return None, it_count
 
 
-def attack(num_traces, load_file, save_file, verbosity, verify_key=False, wrap=None):
+def attack(num_traces, load_file, save_file, verbosity, verify_key=False, wrap=None, early_stop=None):
     if wrap is None and (load_file is None or verify_key):
         wrap = init_wrap()
 
@@ -97,7 +109,7 @@ def attack(num_traces, load_file, save_file, verbosity, verify_key=False, wrap=N
         print("[1] Loading captured traces")
         proj = load(load_file)
         nonces, traces = proj["inputs"], proj["traces"]
-        captured = TraceBatchContainer(traces, nonces, copy=0)
+        captured = TraceBatchContainer(traces, as_values(nonces, 'ad'), copy=0)
         key = proj["key"]
         if wrap is not None:
             wrap.set_key(key)
@@ -107,7 +119,9 @@ def attack(num_traces, load_file, save_file, verbosity, verify_key=False, wrap=N
         wrap.set_key(key)
         # win_size, offset, sample_num = 1, 1953000, num_traces  # Variant compiled with -O0 (or O2?)
         win_size, offset, sample_num = 1, 974000, num_traces  # Variant compiled with -O3
-        captured = capture_traces(wrap, sample_num, win_size, offset, BLOCK_SIZE)
+        # stop capturing once the CPA is stable (the number of traces is then a maximum)
+        on_batch = EarlyStopping(_cpa_engines(), [0] * BLOCK_SIZE, early_stop) if early_stop else None
+        captured = capture_traces(wrap, sample_num, win_size, offset, BLOCK_SIZE, on_batch=on_batch)
 
         if save_file is not None:
             save(save_file, key, captured.values, captured.leakages, bytes(), bytes())
@@ -128,7 +142,7 @@ def attack(num_traces, load_file, save_file, verbosity, verify_key=False, wrap=N
         pt, nonce, ct = None, None, None
 
     print("[2] Run correlation analysis on captured traces")
-    masks = _run_cpa(captured)
+    masks, mask_scores = _run_cpa(captured)
 
     initially_incorrect_bytes = 0
     unrecoverable_bytes = 0
@@ -148,7 +162,7 @@ def attack(num_traces, load_file, save_file, verbosity, verify_key=False, wrap=N
         print(initially_incorrect_bytes, "bytes are incorrect before exhaustive search")
 
     print("[4] Find the correct result")
-    res, it_count = exhaustive_search(pt, nonce, ct, masks)
+    res, it_count = exhaustive_search(pt, nonce, ct, masks, mask_scores)
 
     if res is not None:
         print("[=>] Got:\t\t\t\t", res.hex())
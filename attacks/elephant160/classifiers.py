@@ -3,6 +3,9 @@ import numpy as np
 from numba import njit
 from lascar import hamming
 
+from util.cpa import xor_model_table
+from ..elephant_generic.classifiers import player_tables, round_counters, spongent_rounds, spongent_inverse_rounds
+
 # Constants
 state_bits = 160
 state_bytes = state_bits // 8
@@ -54,6 +57,9 @@ def pi(i):
     return i if i == state_bits - 1 else (i * state_bits//4) % (state_bits - 1)
 
 
+player_table, player_inverse_table = player_tables(pi, state_bytes)
+
+
 def counter(lfsr):
     """Iterates the counter for the permutation round"""
     lfsr = (lfsr << 1) | (((0x40 & lfsr) >> 6) ^ ((0x20 & lfsr) >> 5))
@@ -152,6 +158,16 @@ def spongent(state: bytes, rounds=None):
     return bytes(state)
 
 
+def spongent_batch(states, rounds=n_rounds):
+    """spongent on a (n, state_bytes) uint8 batch of states"""
+    return spongent_rounds(np.asarray(states, np.uint8), round_counters(lfsr_iv, rounds), player_table)
+
+
+def spongent_inverse_batch(states, rounds=n_rounds):
+    """spongent_inverse on a (n, state_bytes) uint8 batch of states"""
+    return spongent_inverse_rounds(np.asarray(states, np.uint8), round_counters(lfsr_iv, rounds), player_inverse_table)
+
+
 def print_debug(round, state):
     if debug:
         print(round, ' '.join(['{:02X}'.format(x) for x in state[::-1]]), sep='\t')
@@ -183,6 +199,11 @@ def classifier_ad(position, ad: np.ndarray, guess):
 
     return hamming(result)
 
+
+def classifier_ad_table(position):
+    """Hypotheses of classifier_ad for all (guess, ad byte) pairs"""
+    return xor_model_table([hamming(classifier(s, position)) for s in range(256)])
+
 @njit
 def rotl3(b):
     return (0xff & (b << 3)) | (b >> 5)
@@ -216,3 +237,9 @@ def mask_lfsr_goback(state):
     return bytes(out)
 
 
+def mask_lfsr_goback_batch(states):
+    """mask_lfsr_goback on a (n, state_bytes) uint8 batch of masks"""
+    out = np.empty_like(states)
+    out[:, 0] = rotr3((states[:, 2] << 7) ^ (states[:, 12] >> 7) ^ states[:, 19])
+    out[:, 1:] = states[:, :-1]
+    return out
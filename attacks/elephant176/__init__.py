@@ -2,6 +2,7 @@ import string
 from argparse import ArgumentParser
 
 from runners.cw_basic import WrappedChipWhisperer
+from runners.cw_simulated import SimulatedChipWhisperer
 import chipwhisperer as cw
 
 
@@ -14,9 +15,16 @@ def init_subcommand(subparser: ArgumentParser):
                            help='override the number of traces to capture')
     subparser.add_argument('--verify-key', dest='verify_key', action='store_const', const=True, default=False,
                            help='capture a known plaintext-ciphertext pair on the device to verify the key')
+    subparser.add_argument('--early-stop', dest='early_stop', type=int, default=None, metavar='batches',
+                           help='stop capturing once the best guess of every byte has been stable for this many batches '
+                                'of traces (the number of traces becomes a maximum)')
 
 
-def init_wrap():
+def init_wrap(simulation=None):
+    """:param simulation: if given, the options (noise, jitter, seed) of a simulated board (see SimulatedChipWhisperer)"""
+    if simulation is not None:
+        return SimulatedChipWhisperer(alg='elephant176v2', platform='CWLITEARM', **simulation)
+
     input("Please connect the board and press enter.")
     return WrappedChipWhisperer(
         alg='elephant176v2',
@@ -27,7 +35,7 @@ def init_wrap():
 
 def run(args):
     from .attack import attack
-    attack(args.num_traces, args.load, args.save, args.verbosity, args.verify_key)
+    attack(args.num_traces, args.load, args.save, args.verbosity, args.verify_key, early_stop=args.early_stop)
 
 
 def run_benchmark(parameters: dict[string, any], wrap) -> tuple[string, dict[string, any]]:
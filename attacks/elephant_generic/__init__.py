@@ -12,6 +12,9 @@ def init_subcommand(subparser: ArgumentParser):
                            help='override the number of traces to capture')
     subparser.add_argument('--verify-key', dest='verify_key', action='store_const', const=True, default=False,
                            help='capture a known plaintext-ciphertext pair on the device to verify the key')
+    subparser.add_argument('--early-stop', dest='early_stop', type=int, default=None, metavar='batches',
+                           help='stop capturing once the best guess of every byte has been stable for this many batches '
+                                'of traces (the number of traces becomes a maximum)')
     subparser.add_argument('-b', '--block-size', dest='block_size', type=int, choices=[160,176], default=160,
                            help='targetted variant of the cipher')
 
@@ -27,5 +30,6 @@ def run(args):
     from .attack import attack
     from .classifiers import JumboModel, DumboModel
     classifier = JumboModel() if args.block_size == 176 else DumboModel()
-    attack(args.num_traces, args.load, args.save, args.verbosity, classifier, args.verify_key, init_wrap(args.block_size))
+    attack(args.num_traces, args.load, args.save, args.verbosity, classifier, args.verify_key, init_wrap(args.block_size),
+           early_stop=args.early_stop)
 
@@ -4,10 +4,13 @@ from tqdm import tqdm
 from util import to_bytes
 from lascar import TraceBatchContainer
 
+from runners.cw_simulated import SimulatedChipWhisperer
+from util.values import pack_values
+
 
 def capture_traces(wrap,
                    n_samples, cap_num_windows, cap_first_offset,
-                   block_size):
+                   block_size, on_batch=None, batch_size=5):
     """
     A re-implementaton of wrap.capture_traces specifically designed for the elephant attack
     :param wrap:
@@ -16,13 +19,20 @@ def capture_traces(wrap,
     :param cap_first_offset:
     :param nonce_gen:
     :param ad_gen:
-    :return:
+    :param on_batch: called with the traces and values of each batch of batch_size traces, stops the capture if it
+        returns True (see WrappedChipWhisperer.capture_traces)
+    :param batch_size:
+    :return: a container whose values are the attacked AD block of each trace, in the ad field (see util.values)
     """
 
     first_ad_block_size = block_size - 12
     nonce_gen = lambda: np.zeros(12, np.uint8)
     ad_gen = lambda: np.random.randint(0, 256, first_ad_block_size + block_size, np.uint8)
 
+    if isinstance(wrap, SimulatedChipWhisperer):
+        return _simulate_traces(wrap, n_samples, cap_num_windows, cap_first_offset, block_size, nonce_gen, ad_gen,
+                                on_batch, batch_size)
+
     cap_len = 24000 * cap_num_windows
     target, scope = wrap.target, wrap.scope
 
@@ -32,14 +42,15 @@ def capture_traces(wrap,
     scope.adc.timeout = 2
     scope.adc.samples = 24000
 
-    traces = []
-    values = []
+    traces = np.empty((n_samples, cap_len), np.float32)
+    values = np.empty((n_samples, block_size), np.uint8)
+    count = 0
 
     for _ in tqdm(range(n_samples), desc='Capturing traces'):
         target.flush()
         wrap.reset()
 
-        trace = np.zeros(cap_len)
+        trace = traces[count]
         nonce = nonce_gen()
         ad = ad_gen()
         wrap._set_ad(to_bytes(ad))
@@ -59,7 +70,29 @@ def capture_traces(wrap,
 
             while scope.adc.state: time.sleep(0.005)
 
-        traces.append(trace)
-        values.append(ad[first_ad_block_size:first_ad_block_size + block_size])
+        values[count] = ad[first_ad_block_size:first_ad_block_size + block_size]
+        count += 1
+
+        if on_batch is not None and count % batch_size == 0:
+            if on_batch(traces[count - batch_size:count], pack_values(ad=values[count - batch_size:count])):
+                print(f"Stopping the capture early, after {count} traces")
+                break
+
+    return TraceBatchContainer(traces[:count], pack_values(ad=values[:count]), copy=0)
+
+
+def _simulate_traces(wrap, n_samples, cap_num_windows, cap_first_offset, block_size, nonce_gen, ad_gen, on_batch,
+                     batch_size):
+    """capture_traces on a simulated board, the values are cut to the attacked AD block in the same way"""
+    first_ad_block_size = block_size - 12
+
+    def attacked_block(values):
+        return pack_values(ad=values['ad'][:, first_ad_block_size:first_ad_block_size + block_size])
+
+    batch_callback = None
+    if on_batch is not None:
+        batch_callback = lambda traces, values: on_batch(traces, attacked_block(values))
 
-    return TraceBatchContainer(np.array(traces), np.array(values), copy=0)
+    captured = wrap.capture_traces(None, n_samples, cap_num_windows=cap_num_windows, cap_first_offset=cap_first_offset,
+                                   nonce_gen=nonce_gen, ad_gen=ad_gen, on_batch=batch_callback, batch_size=batch_size)
+    return TraceBatchContainer(captured.leakages, attacked_block(captured.values), copy=0)
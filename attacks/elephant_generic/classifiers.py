@@ -3,6 +3,8 @@ import numpy as np
 from numba import njit
 from lascar import hamming
 
+from util.cpa import xor_model_table
+
 # Constants
 
 debug = False
@@ -28,6 +30,7 @@ sbox_list = [
 # njit requires numpy arrays to work
 sbox_ndarray = np.array(sbox_list)
 sbox_inverse = [sbox_list.index(i) for i in range(0xff + 1)]
+sbox_inverse_ndarray = np.array(sbox_inverse)
 
 
 #
@@ -52,6 +55,89 @@ def counter(lfsr):
     lfsr &= 0x7f
     return lfsr
 
+
+def round_counters(lfsr_iv, rounds):
+    """The counters added to the state by each round of the permutation"""
+    counters = [lfsr_iv]
+    for i in range(rounds - 1):
+        counters.append(counter(counters[-1]))
+    return np.array(counters, np.uint8)
+
+
+def player_tables(pi, state_bytes):
+    """
+    Byte-level lookup tables of the pLayer and of its inverse
+    :param pi: the bit permutation
+    :return: two (state_bytes, 256, state_bytes) tables, the permutation of a state being the xor over its bytes i of
+        table[i, state[i]]
+    """
+    forward = np.zeros((state_bytes, 256, state_bytes), np.uint8)
+    inverse = np.zeros((state_bytes, 256, state_bytes), np.uint8)
+    values = np.arange(256)
+
+    for i in range(state_bytes):
+        for j in range(8):
+            target_bitno = pi(8 * i + j)
+            forward[i, (values >> j) & 1 == 1, target_bitno // 8] |= 1 << (target_bitno % 8)
+            inverse[target_bitno // 8, (values >> (target_bitno % 8)) & 1 == 1, i] |= 1 << j
+
+    return forward, inverse
+
+
+@njit
+def _permute(state, table, tmp):
+    tmp[:] = 0
+    for i in range(state.shape[0]):
+        row = table[i, state[i]]
+        for j in range(state.shape[0]):
+            tmp[j] ^= row[j]
+    state[:] = tmp
+
+
+@njit
+def spongent_rounds(states, counters, table):
+    """
+    Spongent permutation of a batch of states
+    :param states: a (n, state_bytes) uint8 array
+    :param counters: the counter of each round (see round_counters)
+    :param table: the pLayer table (see player_tables)
+    :return: the (n, state_bytes) permuted states
+    """
+    states = states.copy()
+    last = states.shape[1] - 1
+    tmp = np.empty(states.shape[1], np.uint8)
+
+    for k in range(states.shape[0]):
+        state = states[k]
+        for c in counters:
+            state[0] ^= c
+            state[last] ^= reverse_bits(c)
+            for i in range(state.shape[0]):
+                state[i] = sbox_ndarray[state[i]]
+            _permute(state, table, tmp)
+
+    return states
+
+
+@njit
+def spongent_inverse_rounds(states, counters, table):
+    """Inverse of spongent_rounds, table being the inverse pLayer table"""
+    states = states.copy()
+    last = states.shape[1] - 1
+    tmp = np.empty(states.shape[1], np.uint8)
+
+    for k in range(states.shape[0]):
+        state = states[k]
+        for r in range(counters.shape[0] - 1, -1, -1):
+            _permute(state, table, tmp)
+            for i in range(state.shape[0]):
+                state[i] = sbox_inverse_ndarray[state[i]]
+            state[0] ^= counters[r]
+            state[last] ^= reverse_bits(counters[r])
+
+    return states
+
+
 class ElephantGeneric:
     def __init__(self, state_bits, n_rounds, lfsr_iv, attack_point):
         """
@@ -67,10 +153,22 @@ class ElephantGeneric:
         self.lfsr_iv = lfsr_iv
         self.BLOCK_SIZE = self.state_bytes
         self.attack_point = attack_point
+        self.player_table, self.player_inverse_table = player_tables(self.pi, self.state_bytes)
 
     def pi(self, i):
         return i if i == self.state_bits - 1 else (i * self.state_bits//4) % (self.state_bits - 1)
 
+    def spongent_batch(self, states, rounds=None):
+        """spongent on a (n, state_bytes) uint8 batch of states"""
+        if rounds is None: rounds = self.n_rounds
+        return spongent_rounds(np.asarray(states, np.uint8), round_counters(self.lfsr_iv, rounds), self.player_table)
+
+    def spongent_inverse_batch(self, states, rounds=None):
+        """spongent_inverse on a (n, state_bytes) uint8 batch of states"""
+        if rounds is None: rounds = self.n_rounds
+        return spongent_inverse_rounds(np.asarray(states, np.uint8), round_counters(self.lfsr_iv, rounds),
+                                       self.player_inverse_table)
+
     def spongent_inverse(self, state, rounds=None):
         if rounds is None: rounds = self.n_rounds
 
@@ -184,6 +282,11 @@ def classifier_ad(lfsr_iv, state_bytes, position, ad: np.ndarray, guess):
 
     return hamming(result)
 
+
+def classifier_ad_table(lfsr_iv, state_bytes, position):
+    """Hypotheses of classifier_ad for all (guess, ad byte) pairs"""
+    return xor_model_table([hamming(classifier(lfsr_iv, state_bytes, s, position)) for s in range(256)])
+
 def print_debug(round, state):
     if debug:
         print(round, ' '.join(['{:02X}'.format(x) for x in state[::-1]]), sep='\t')
@@ -238,6 +341,13 @@ class JumboModel(ElephantGeneric):
 
         return bytes(out)
 
+    def mask_lfsr_goback_batch(self, states):
+        """mask_lfsr_goback on a (n, state_bytes) uint8 batch of masks"""
+        out = np.empty_like(states)
+        out[:, 0] = rotr((states[:, 2] << 7) ^ (states[:, 18] >> 7) ^ states[:, 21])
+        out[:, 1:] = states[:, :-1]
+        return out
+
 
 class DumboModel(ElephantGeneric):
     def __init__(self):
@@ -266,5 +376,12 @@ class DumboModel(ElephantGeneric):
 
         return bytes(out)
 
+    def mask_lfsr_goback_batch(self, states):
+        """mask_lfsr_goback on a (n, state_bytes) uint8 batch of masks"""
+        out = np.empty_like(states)
+        out[:, 0] = rotr3((states[:, 2] << 7) ^ (states[:, 12] >> 7) ^ states[:, 19])
+        out[:, 1:] = states[:, :-1]
+        return out
+
 
 
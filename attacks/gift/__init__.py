@@ -4,6 +4,7 @@ from argparse import ArgumentParser
 import util.constants
 
 from runners.cw_basic import WrappedChipWhisperer
+from runners.cw_simulated import SimulatedChipWhisperer
 import chipwhisperer as cw
 
 def init_subcommand(subparser: ArgumentParser):
@@ -14,7 +15,11 @@ def run(args):
     from .attack import attack
     attack(verbosity)
 
-def init_wrap():
+def init_wrap(simulation=None):
+    """:param simulation: if given, the options (noise, jitter, seed) of a simulated board (see SimulatedChipWhisperer)"""
+    if simulation is not None:
+        return SimulatedChipWhisperer(alg='giftcofb128v1', platform='CWLITEARM', **simulation)
+
     return WrappedChipWhisperer(
         alg='giftcofb128v1',
         platform='CWLITEARM',
@@ -228,4 +228,27 @@ def sbox(state: np.array) -> np.array:
     state[2] ^= state[0] & state[1]
     state[0], state[3] = state[3], state[0]
 
-    return state
\ No newline at end of file
+    return state
+
+
+@njit
+def simulate_output_states(nonces, key_schedule):
+    """
+    Batched version of simulate_real_output_state (see common.py), for the rounds 1 and 2
+    :param nonces: a (traces, 16) uint8 array
+    :return: a (traces, 2, 4) uint32 array, the states after the sbox of the round following round 1 and round 2
+    """
+    states = np.empty((nonces.shape[0], 2, 4), np.uint32)
+
+    for t in range(nonces.shape[0]):
+        state = np.zeros(4, np.uint32)
+        for w in range(4):
+            state[w] = (np.uint32(nonces[t, 4 * w]) << 24) | (np.uint32(nonces[t, 4 * w + 1]) << 16) \
+                       | (np.uint32(nonces[t, 4 * w + 2]) << 8) | np.uint32(nonces[t, 4 * w + 3])
+        schedule = key_schedule.copy()
+
+        for r in range(2):
+            simulate_round(r, state, schedule)
+            states[t, r] = sbox(state.copy())
+
+    return states
@@ -2,6 +2,7 @@ import string
 from argparse import ArgumentParser
 
 from runners.cw_basic import WrappedChipWhisperer
+from runners.cw_simulated import SimulatedChipWhisperer
 import chipwhisperer as cw
 TPL_PATH = "./attacks/photonbeetle/models/"
 
@@ -22,6 +23,24 @@ def init_subcommand(subparser: ArgumentParser):
     train.add_argument('-e', '--array-end', dest='array_end', type=int, default=None,
                        help='index of the first position in the traces to exclude')
     train.add_argument('-w', '--windows', dest='windows', type=int, default=1, help='number of windows to capture')
+    train.add_argument('-p', '--num-pois', dest='num_pois', type=int, default=5,
+                       help='number of points of interest of each template')
+    train.add_argument('--poi-spacing', dest='poi_spacing', type=int, default=5,
+                       help='minimum distance between two points of interest')
+    train.add_argument('-t', '--num-threads', dest='threads', type=int, default=None,
+                       help='how many processes to use to fit the templates (by default: number of cores)')
+    train.add_argument('--refit', dest='refit', action='store_const', const=True, default=False,
+                       help='fit the template again from the profiling traces kept by a previous run (no capture)')
+    train.add_argument('--keep-traces', dest='keep_traces', action='store_const', const=True, default=False,
+                       help='write the profiling traces next to the template, to fit it again later with --refit')
+    train.add_argument('--poi-traces', dest='poi_traces', type=int, default=1000,
+                       help='number of traces kept in memory to select the points of interest from')
+    train.add_argument('--simulate', dest='simulate', action='store_const', const=True, default=False,
+                       help='capture the profiling traces on a simulated board (see runners/cw_simulated.py)')
+    train.add_argument('--noise', dest='noise', type=float, default=0.25,
+                       help='standard deviation of the noise of the simulated traces')
+    train.add_argument('--jitter', dest='jitter', type=int, default=0,
+                       help='maximum shift (in samples) of the leakage of the simulated traces')
 
     # attack
     attack = sp2.add_parser('attack', help='launch an attack on a device using the template')
@@ -35,7 +54,11 @@ def init_subcommand(subparser: ArgumentParser):
                        help='how many threads to use in the final step (by default: number of cores)')
 
 
-def init_wrap():
+def init_wrap(simulation=None):
+    """:param simulation: if given, the options (noise, jitter, seed) of a simulated board (see SimulatedChipWhisperer)"""
+    if simulation is not None:
+        return SimulatedChipWhisperer(alg='photonbeetleaead128rate128v1-bitslice_sb32', platform='CWLITEARM', **simulation)
+
     # This works for benchmarks but not anything else
     return WrappedChipWhisperer(alg='photonbeetleaead128rate128v1-bitslice_sb32',
                                 platform='CWLITEARM', target_type=cw.targets.SimpleSerial,
@@ -1,20 +1,70 @@
-import itertools
+import atexit
 import random
 from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-from scipy.stats import multivariate_normal
 from tqdm import tqdm
 
 from runners.cw_basic import WrappedChipWhisperer
-from runners.native import NativeRunner
+from runners.parallel import match_ciphertext, shared_verifier
 from . import TPL_PATH
-from .classifier import select_column, compute_round_1, reorder
-import pickle
+from .classifier import select_column, round_1_hypotheses, reorder
+from .templates import load_template
 import os.path
 import chipwhisperer as cw
 import multiprocessing
 from util import constants
+from util.enumeration import enumerate_keys
+from util.shared_arrays import SharedArrays, attach
+
+# Scorers of the 8 columns of the template of the current worker process, loaded once by _init_worker
+_scorers = None
+
+
+def _init_worker(tpl_name):
+    global _scorers
+    template = load_template(tpl_name)
+    _scorers = [template.scorer(col) for col in range(8)]
+
+    # warm up the hypotheses (key parts of the columns) and the scoring, so that the first attack is not slower
+    for col in range(8):
+        round_1_hypotheses(col, 0)
+        _scorers[col].score(np.zeros((1, _scorers[col].pois.max() + 1)))
+
+
+_pools = {}
+
+
+def _column_pool(tpl_name, threads):
+    """
+    Returns a persistent pool whose workers have loaded the template, created on first use and reused by the later
+    attacks (e.g. by all the runs of a benchmark).
+
+    The pool is tied to the version of the template file (inode and modification time): if the template was written
+    again since (e.g. by --refit), the pool of the previous version is shut down and a new one loads the template.
+    """
+    stat = os.stat(tpl_name)
+    version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    key = (tpl_name, threads)
+
+    pool_version, pool = _pools.get(key, (None, None))
+    if pool is None or pool_version != version:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        pool = ProcessPoolExecutor(max_workers=threads, initializer=_init_worker, initargs=(tpl_name,))
+        _pools[key] = (version, pool)
+    return pool
+
+
+def close_column_pools():
+    """Shuts down the pools returned by _column_pool (called at exit)"""
+    for _, pool in _pools.values():
+        pool.shutdown(cancel_futures=True)
+    _pools.clear()
+
+
+atexit.register(close_column_pools)
+
 
 def attack(args, wrap=None):
     tpl_name = args.template
@@ -30,44 +80,31 @@ def attack(args, wrap=None):
         print("No such model file:", tpl_name)
         exit(1)
 
-    with open(tpl_name, 'rb') as model_file:
-        template_data = pickle.load(model_file)
+    template = load_template(tpl_name)
 
-    return _do_attack(num_traces, num_identical, keep_n, template_data, threads, wrap)
+    return _do_attack(num_traces, num_identical, keep_n, template, _column_pool(tpl_name, threads), threads, wrap)
 
 
-def _exhaustive_search(pt, nonce, ct, key_options):
-    runner = NativeRunner("bin/photon-beetle.so")
-    num_it = 0  # for benchmarking
+def _match_columns(runner, columns, pt, nonce, ct):
+    """Checks a chunk of column candidates on a worker of the verifier"""
+    return match_ciphertext(runner, [reorder(value) for value in columns], pt, nonce, ct)
 
-    print("[-] Running exhaustive search with pt=" + pt.hex() + ", nonce=" + nonce.hex() + ", expected ct=" + ct.hex())
-    for n_errors in range(len(key_options)):
-        # which byte will we check
-        print("[-] Trying with", n_errors, "wrong columns...")
-        wrong_bytes_combinations = itertools.combinations(range(len(key_options)), n_errors)
-
-        for wrong_bytes in wrong_bytes_combinations:
-            possible_values = itertools.product(*[k if i in wrong_bytes else [k[0]] for i, k in enumerate(key_options)])
-
-            for value in possible_values:
-                key = reorder(value)
-                res = runner.encrypt(key, pt, nonce)
-                print("\r  hypothesis", key.hex(), "  eq?", res == ct, end='')
-                num_it += 1
-                # print("\t", value.hex(), res.hex(), ct.hex(), res==ct)
-                if res == ct:
-                    print()
-                    return key, num_it
 
-        print()
-    return None, num_it
+def _exhaustive_search(pt, nonce, ct, key_options, key_scores, threads=None):
+    verifier = shared_verifier("bin/photon-beetle.so", threads)
 
+    print("[-] Running exhaustive search with pt=" + pt.hex() + ", nonce=" + nonce.hex() + ", expected ct=" + ct.hex())
+    # Columns are independent, so the log-likelihood of a key is the sum of the log-likelihoods of its columns
+    found, num_it = verifier.search(enumerate_keys(key_options, key_scores), _match_columns, pt, nonce, ct)
 
-def _do_attack(num_traces, num_identical, keep_n, template_data, threads, wrap=None):
-    params = template_data['params']
-    all_models = template_data['templates']
+    if found is None:
+        return None, num_it
+    return reorder(found), num_it
 
 
+def _do_attack(num_traces, num_identical, keep_n, template, pool, threads, wrap=None):
+    params = template.params
+
     platform = params['platform']
     executable = params['executable']
     win_size = params['num_windows']
@@ -97,23 +134,27 @@ def _do_attack(num_traces, num_identical, keep_n, template_data, threads, wrap=N
 
     print("[4] Finding key bytes...")
     col_results = []
+    col_scores = []
     col_num_iter = []
-    nonces = [int.from_bytes(x.tobytes(), 'big') for x in data.values]
-
-    exec = ProcessPoolExecutor(max_workers=threads)
 
-    futures = []
-    for i in range(8):
-        future = exec.submit(_predict, nonces.copy(), data.leakages[:,start:end].copy(), all_models.copy(), i, num_identical, keep_n)
-        futures.append(future)
+    # the traces and nonces are published once, the workers already loaded the templates
+    shared = SharedArrays(traces=data.leakages[:, start:end], nonces=data.values['nonce'])
+    try:
+        futures = []
+        for i in range(8):
+            future = pool.submit(_predict_shared, shared.handles, i, num_identical, keep_n)
+            futures.append(future)
 
-    print()
+        print()
 
-    for i in range(8):
-        # Wait for all features in order
-        res, it = futures[i].result()
-        col_results.append(res)
-        col_num_iter.append(it)
+        for i in range(8):
+            # Wait for all features in order
+            res, scores, it = futures[i].result()
+            col_results.append(res)
+            col_scores.append(scores)
+            col_num_iter.append(it)
+    finally:
+        shared.close()
 
     print("[5] Searching for correct key")
     # Remove constant
@@ -135,7 +176,7 @@ def _do_attack(num_traces, num_identical, keep_n, template_data, threads, wrap=N
 
     print("[-] Starting exhaustive search")
 
-    found_key, num_it = _exhaustive_search(pt, nonce, ct, col_results)
+    found_key, num_it = _exhaustive_search(pt, nonce, ct, col_results, col_scores, threads)
 
     if found_key is None:
         print("Correct key not found, sorry.")
@@ -149,35 +190,36 @@ def _do_attack(num_traces, num_identical, keep_n, template_data, threads, wrap=N
         return constants.STATUS_WRONG_KEY, col_num_iter, num_it, initially_incorrect_bytes, unrecoverable_bytes
 
 
-def _predict(nonces, traces, models, col, num_identical=25, return_top=4):
+def _predict_shared(handles, col, num_identical=25, return_top=4):
+    """Runs _predict on a worker, on the traces and nonces published with SharedArrays"""
+    arrays, segments = attach(handles)
+    try:
+        nonces = [int.from_bytes(x.tobytes(), 'big') for x in arrays['nonces']]
+        return _predict(nonces, arrays['traces'], _scorers[col], col, num_identical, return_top)
+    finally:
+        # the views must be released before closing the segments
+        del arrays
+        for segment in segments:
+            segment.close()
+
+
+def _predict(nonces, traces, scorer, col, num_identical=25, return_top=4):
     # Select the 2 bytes of the nonce that are used for this column
     nonces_selected = [select_column(n, col, nonce=True) for n in nonces]
 
-    # Get models and POI for this column
-    models = models[col]
-    POIs = [p for p, m, c in models]
-
-    # Precompute the multivariate normal distribution for all rows in the column
-    rv = [[multivariate_normal(means[HW], covs[HW]) for HW in range(5)] for _, means, covs in models]
+    # Compute the log-likelihoods of all the traces, for all the rows and hamming weights of this column, at once
+    estimates = scorer.score(traces)
 
     key_candidates_scores = np.zeros(2 ** 16)
     last_top = None
     identical_for = 0
 
-    for j, trace in tqdm(enumerate(traces), desc=f"Evaluating column {col}...", position=col, total=len(traces)):
-        a = [trace[POI] for POI in POIs]
+    for j in tqdm(range(len(traces)), desc=f"Evaluating column {col}...", position=col):
         nonce = nonces_selected[j]
 
-        # Compute the distribution for all hamming weights once (it's the longest operation, and doing it only once
-        # saves a lot of time)
-        estimates = [[np.log(rv[row][HW].pdf(a[row])) for HW in range(5)] for row in range(8)]
-
-        # Test each key candidate
-        for key in range(2 ** 16):
-            round1_model = compute_round_1(col, nonce, key)
-
-            for row, HW in enumerate(round1_model):
-                key_candidates_scores[key] += estimates[row][HW]
+        # Test all the key candidates at once: the hamming weights of the rows index the estimates
+        hypotheses = round_1_hypotheses(col, nonce)
+        key_candidates_scores += estimates[j][np.arange(8), hypotheses].sum(axis=1)
 
         argsorted = key_candidates_scores.argsort()[::-1][:16]
 
@@ -191,5 +233,6 @@ def _predict(nonces, traces, models, col, num_identical=25, return_top=4):
             # Fast exit if we have a stable candidate
             break
 
-    return key_candidates_scores.argsort()[::-1][:return_top], j
+    top = key_candidates_scores.argsort()[::-1][:return_top]
+    return top, key_candidates_scores[top], j
 
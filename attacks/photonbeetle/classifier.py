@@ -1,6 +1,11 @@
+from functools import lru_cache
+
 from lascar.tools.leakage_model import _hw as hw
 from .constants import *
 
+FIELD_MULT = np.array(field_mult_arr, np.uint8)
+HW_4 = np.array([bin(i).count('1') for i in range(16)], np.uint8)
+
 
 def field_mult(a, b):
     c = field_mult_arr[a][b]
@@ -39,6 +44,42 @@ def compute_round_1(col, nonce, key):
     return hw[state]
 
 
+def _mix_column_part(col, values, offset):
+    """
+    MixColumn output of 4 nibbles of the state in compute_round_1 (the nonce at offset 0, the key at offset 4), the
+    others being 0. As MixColumn is linear, the output of the round is the xor of the parts of the nonce and of the key.
+    :param values: an array of 16 bits values (4 nibbles)
+    :return: a (len(values), 8) uint8 array
+    """
+    nibbles = (np.asarray(values)[:, None] >> np.array([12, 8, 4, 0])) & 0xf
+
+    # AddConstants, on the row s.t. row == col
+    constant_row = (8 - col) % StateSize
+    if offset <= constant_row < offset + 4:
+        nibbles[:, constant_row - offset] ^= RC[constant_row][0]
+
+    nibbles = sbox[nibbles]
+
+    part = np.zeros((len(nibbles), StateSize), np.uint8)
+    for k in range(4):
+        part ^= FIELD_MULT[MixColMatrix[:, offset + k][None, :], nibbles[:, k][:, None]]
+    return part
+
+
+@lru_cache(maxsize=StateSize)
+def _key_part(col):
+    """MixColumn part of all the 2**16 key values of a column, see _mix_column_part"""
+    return _mix_column_part(col, np.arange(2 ** 16), 4)
+
+
+def round_1_hypotheses(col, nonce):
+    """
+    Batched version of compute_round_1, for all the 2**16 keys of a column
+    :return: a (2**16, 8) uint8 matrix, the hamming weights of the rows for each key
+    """
+    return HW_4[_key_part(col) ^ _mix_column_part(col, np.array([nonce]), 0)]
+
+
 
 def reverse_round(key):
     """Reverses the first operations of the round (before mixcolumn)"""
@@ -3,16 +3,21 @@ import random
 
 from attacks.photonbeetle import TPL_PATH
 from .classifier import select_column, compute_round_1
+from .templates import Template, save_template
 import numpy as np
 import chipwhisperer as cw
 
-import itertools
-import pickle
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from runners.cw_basic import WrappedChipWhisperer
+from runners.cw_simulated import SimulatedChipWhisperer
 import os.path
 
 NUM_POIS = 5
 POI_MIN_SPACING = 5
+# number of traces kept in memory to select the POIs from
+POI_TRACES = 1000
+
 
 def create_template(args):
     platform, prog, windows = ('CWLITEXMEGA', cw.programmers.XMEGAProgrammer, 1) if args.platform == 'xmega' else ('CWLITEARM', cw.programmers.STM32FProgrammer, 3)
@@ -33,52 +38,152 @@ def create_template(args):
 
     tpl_name = TPL_PATH + tpl_name + ".tpl"
 
-    _do_create_template(platform, prog, capture_params, binary_file, num_traces, tpl_name)
-
-def _fit(X, Y, col, row):
-    X = X[:,col,row]  # select only the interesting column and row
-    categories = [np.argwhere(X == i)[:,0] for i in range(5)]  # categorize the inputs
-    arrays = [Y[k] for k in categories]
-    averages = np.array([np.mean(k, axis=0) for k in arrays])
+    simulation = {'noise': args.noise, 'jitter': args.jitter} if args.simulate else None
+    _do_create_template(platform, prog, capture_params, binary_file, num_traces, tpl_name, args.num_pois,
+                        args.poi_spacing, args.threads, args.refit, simulation, args.keep_traces, args.poi_traces)
 
-    diffs = [np.abs(a - b) for a, b in itertools.combinations(averages, 2)]
-    sum_of_differences = np.sum(diffs, axis=0)
+def _select_pois(averages, num_pois=NUM_POIS, min_spacing=POI_MIN_SPACING):
+    """Selects the POIs of a (col, row) from the (5, samples) average traces of its hamming weights"""
+    first, second = np.triu_indices(len(averages), 1)
+    sum_of_differences = np.abs(averages[first] - averages[second]).sum(axis=0)
 
     POIs = []
-    for i in range(NUM_POIS):
+    for i in range(num_pois):
         # Find the biggest peak and add it to the list of POIs
         next_POI = sum_of_differences.argmax()
         POIs.append(next_POI)
 
         # Set nearby points to 0 to make sure we don't capture them too
-        for j in range(max(0, next_POI - POI_MIN_SPACING), min(next_POI + POI_MIN_SPACING, len(sum_of_differences))):
-            sum_of_differences[j] = 0
-
-    mean_matrix = np.zeros((5, NUM_POIS))
-    for HW in range(5):
-        for i in range(NUM_POIS):
-            mean_matrix[HW][i] = averages[HW][POIs[i]]
-
-    covariance_matrix = np.zeros((5, NUM_POIS, NUM_POIS))
-    for HW in range(5):
-        for i in range(NUM_POIS):
-            for j in range(NUM_POIS):
-                x = arrays[HW][:, POIs[i]]
-                y = arrays[HW][:, POIs[j]]
-                covariance_matrix[HW, i, j] = np.cov(x, y)[0][1]
-
-    print("\t[ok] Template fitted for ", col, row)
-    return (POIs, mean_matrix, covariance_matrix)
-
-def _do_create_template(platform, prog, capture_params, binary_file, num_traces, target_file):
-    print(f"Creating a template for {platform} {binary_file}, using {num_traces}")
-    print("[1] Connecting to target platform")
-
-    wrap = WrappedChipWhisperer(alg=binary_file, platform=platform, target_type=cw.targets.SimpleSerial, prog=prog)
-
-    print("[2] Recording traces")
-    X = []
-    Y = []
+        sum_of_differences[max(0, next_POI - min_spacing):next_POI + min_spacing] = 0
+
+    return POIs
+
+
+# Profiling traces and hamming weights of the current worker process, mapped once by _init_fit_worker
+_traces = None
+_labels = None
+
+
+def _init_fit_worker(traces_file, labels_file):
+    global _traces, _labels
+    _traces = np.load(traces_file, mmap_mode='r')
+    _labels = np.load(labels_file, mmap_mode='r')
+
+
+def _fit_range(pois, start, stop, chunk_size=1000):
+    """Accumulates the moments at the POIs of the traces [start, stop), on a worker"""
+    moments = PoiMoments(pois)
+    for i in range(start, stop, chunk_size):
+        end = min(i + chunk_size, stop)
+        moments.update(_traces[i:end], _labels[i:end])
+    return moments
+
+
+def _fit_all(traces_file, labels_file, moments_file, num_pois=NUM_POIS, min_spacing=POI_MIN_SPACING, threads=None):
+    """
+    Fits the templates of the 64 (col, row) from the saved profiling traces, on a pool of processes that map the
+    traces file (the traces are shared through the page cache, not copied to the workers). Each task accumulates the
+    moments of all the (col, row) over a range of traces, so the file is read once and all the threads are used.
+    :return: the templates, as a list (col) of lists (row) of (POIs, means, covs)
+    """
+    moments = np.load(moments_file)
+    pois = _select_all_pois(moments['sums'], moments['counts'], num_pois, min_spacing)
+
+    num_traces = len(np.load(labels_file, mmap_mode='r'))
+    threads = threads if threads is not None else multiprocessing.cpu_count()
+    # a few ranges per thread, so that a slower worker does not hold back the others
+    bounds = np.linspace(0, num_traces, min(num_traces, 4 * threads) + 1).astype(int)
+
+    with ProcessPoolExecutor(max_workers=threads, initializer=_init_fit_worker,
+                             initargs=(traces_file, labels_file)) as pool:
+        futures = [pool.submit(_fit_range, pois, start, stop) for start, stop in zip(bounds, bounds[1:])]
+        total = PoiMoments(pois)
+        for future in tqdm(futures, desc="Fitting templates"):
+            total.merge(future.result())
+
+    return total.templates()
+
+
+class PoiMoments:
+    """
+    Running sums and cross-products of the samples at the POIs of each (col, row), for each of its hamming weights, from
+    which the means and covariances of the templates are computed without keeping the traces
+    """
+
+    def __init__(self, pois):
+        """
+        :param pois: the (col, row, POIs) positions of the POIs
+        """
+        self.pois = np.asarray(pois)
+        num_pois = self.pois.shape[-1]
+        self.counts = np.zeros((8, 8, 5))
+        self.sums = np.zeros((8, 8, 5, num_pois))
+        self.cross = np.zeros((8, 8, 5, num_pois, num_pois))
+
+    def update(self, traces, labels):
+        """
+        :param traces: the (traces, samples) traces to add
+        :param labels: their (traces, col, row) hamming weights
+        """
+        values = np.asarray(traces)[:, self.pois].astype(np.float64)
+        classes = (np.asarray(labels)[..., None] == np.arange(5)).astype(np.float64)
+        weighted = classes[..., :, None] * values[..., None, :]
+        self.counts += classes.sum(axis=0)
+        self.sums += weighted.sum(axis=0)
+        self.cross += np.einsum('nijhp,nijq->ijhpq', weighted, values)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.sums += other.sums
+        self.cross += other.cross
+        return self
+
+    def templates(self):
+        """
+        :return: the templates, as a list (col) of lists (row) of (POIs, means, covs), the covariances having the same
+        normalization as np.cov
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = self.sums / self.counts[..., None]
+            covs = (self.cross - self.sums[..., :, None] * means[..., None, :]) / (self.counts - 1)[..., None, None]
+
+        return [[(list(self.pois[col, row]), means[col, row], covs[col, row]) for row in range(8)] for col in range(8)]
+
+
+def _select_all_pois(sums, counts, num_pois=NUM_POIS, min_spacing=POI_MIN_SPACING):
+    """Selects the (col, row, POIs) POIs from the (col, row, HW, samples) sums and (col, row, HW) counts of the traces"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        averages = sums / counts[..., None]
+    return [[_select_pois(averages[col, row], num_pois, min_spacing) for row in range(8)] for col in range(8)]
+
+
+def _capture(wrap, capture_params, num_traces, num_pois=NUM_POIS, min_spacing=POI_MIN_SPACING,
+             poi_traces=POI_TRACES, traces_file=None):
+    """
+    Captures the profiling traces and accumulates the moments of the templates while they are captured.
+
+    The POIs are selected from the class averages of the first poi_traces traces, which are the only traces kept in
+    memory. From then on, only the sums and cross-products at the POIs of each (col, row, HW) class are accumulated, so
+    the memory used does not depend on the number of traces.
+
+    :param poi_traces: the number of traces to select the POIs from
+    :param traces_file: if given, the traces are also written to this file (to fit the template again with --refit)
+    :return: the (traces, col, row) hamming weights, the (col, row, HW, samples) sums and (col, row, HW) counts of the
+        classes, and the moments at the POIs
+    """
+    X = np.zeros((num_traces, 8, 8), np.uint8)
+    Y = None
+    sums = None
+    moments = None
+    counts = np.zeros((8, 8, 5), np.int64)
+    cols, rows = np.meshgrid(range(8), range(8), indexing='ij')
+    # one trace is captured at a time, always in the same buffer, up to the end of the samples that are kept
+    length = 24000 * capture_params['num_windows']
+    if capture_params['array_end'] is not None:
+        length = len(range(length)[:capture_params['array_end']])
+    buffer = np.empty((1, length), np.float32)
+    first = None
+
     for i in tqdm(range(num_traces), desc="Collecting data"):
         key = random.randbytes(16)
         nonce = random.randbytes(16)
@@ -88,23 +193,80 @@ def _do_create_template(platform, prog, capture_params, binary_file, num_traces,
         keys = [select_column(key_int ^ 0x20, c, False) for c in range(8)]
         nonces = [select_column(nonce_int, c, True) for c in range(8)]
 
-        trace = wrap.capture_traces(key, n_samples=1, cap_num_windows=capture_params['num_windows'], cap_first_offset=0,
-                                    nonce_gen=lambda: np.array(list(nonce), np.uint8), silent=True).leakages[0]
+        wrap.capture_traces(key, n_samples=1, cap_num_windows=capture_params['num_windows'], cap_first_offset=0,
+                            nonce_gen=lambda: np.array(list(nonce), np.uint8), silent=True,
+                            cap_total_len=buffer.shape[1], out=buffer)
+        trace = buffer[0, capture_params['array_start']:]
+
+        if sums is None:
+            sums = np.zeros((8, 8, 5, len(trace)))
+            first = np.empty((min(poi_traces, num_traces), len(trace)), np.float32)
+            if traces_file is not None:
+                Y = np.lib.format.open_memmap(traces_file, mode='w+', dtype=np.float32, shape=(num_traces, len(trace)))
+
+        if Y is not None:
+            Y[i] = trace
+        X[i] = [compute_round_1(col, nonces[col], keys[col]) for col in range(8)]
+        # each (col, row) is in a single class, the indices are unique
+        sums[cols, rows, X[i]] += trace
+        counts[cols, rows, X[i]] += 1
+
+        if moments is not None:
+            moments.update(trace[None], X[i:i + 1])
+        else:
+            first[i] = trace
+            if i == len(first) - 1:
+                # the POIs are known, the first traces are added to the moments and then dropped
+                moments = PoiMoments(_select_all_pois(sums, counts, num_pois, min_spacing))
+                moments.update(first, X[:len(first)])
+                first = None
+
+    if Y is not None:
+        Y.flush()
+    return X, sums, counts, moments
 
-        Y.append(trace[capture_params['array_start']:capture_params['array_end']])
-        X.append([compute_round_1(col, nonces[col], keys[col]) for col in range(8)])
+def _do_create_template(platform, prog, capture_params, binary_file, num_traces, target_file, num_pois=NUM_POIS,
+                        min_spacing=POI_MIN_SPACING, threads=None, refit=False, simulation=None, keep_traces=False,
+                        poi_traces=POI_TRACES):
+    """
+    :param simulation: if given, the options (noise, jitter, seed) of a simulated board (see SimulatedChipWhisperer)
+    :param keep_traces: also write the profiling traces next to the template, so that it can be fitted again (--refit)
+    :param poi_traces: the number of traces to select the POIs from
+    """
+    traces_file = target_file + ".traces.npy"
+    labels_file = target_file + ".labels.npy"
+    moments_file = target_file + ".moments.npz"
 
-    X = np.array(X)
-    Y = np.array(Y)
+    if refit:
+        if not os.path.exists(traces_file):
+            raise ValueError(f"No profiling traces in {traces_file}, the template must be created with --keep-traces "
+                             f"to be fitted again")
 
-    print("[3] Fitting templates")
-    templates = [[_fit(X, Y, col, row) for row in range(8)] for col in range(8)]
+        print(f"Fitting the template for {platform} {binary_file} again, from the traces of", traces_file)
+        print("[3] Fitting templates")
+        templates = _fit_all(traces_file, labels_file, moments_file, num_pois, min_spacing, threads)
+    else:
+        print(f"Creating a template for {platform} {binary_file}, using {num_traces}")
+        print("[1] Connecting to target platform")
+
+        if simulation is not None:
+            wrap = SimulatedChipWhisperer(alg=binary_file, platform=platform, **simulation)
+        else:
+            wrap = WrappedChipWhisperer(alg=binary_file, platform=platform, target_type=cw.targets.SimpleSerial, prog=prog)
+
+        print("[2] Recording traces and fitting templates")
+        X, sums, counts, moments = _capture(wrap, capture_params, num_traces, num_pois, min_spacing, poi_traces,
+                                            traces_file if keep_traces else None)
+        templates = moments.templates()
+
+        if keep_traces:
+            np.save(labels_file, X)
+            np.savez(moments_file, sums=sums, counts=counts)
+            print(f"[-] Kept the profiling traces in {traces_file} ({os.path.getsize(traces_file) / 2 ** 30:.1f} GiB), "
+                  f"delete them once they are not needed for --refit")
 
     print("[4] Saving template")
-    tpl_obj = {'params': capture_params, 'templates': templates}
-    with open(target_file, 'wb') as model_file:
-        pickle.dump(tpl_obj, model_file)
+    save_template(target_file, Template.from_models(capture_params, templates))
 
     print("[I] Done! Wrote template to", target_file)
     return
-
@@ -0,0 +1,149 @@
+import json
+import os
+import pickle
+
+import numpy as np
+
+# Version of the template files written by save_template
+TEMPLATE_VERSION = 1
+
+_MAGIC = b'PBTEMPLATE\x00\x00'
+# Alignment of the header and of the arrays in the template files
+_ALIGNMENT = 64
+
+
+def gaussian_parameters(covs):
+    """
+    Precomputes the parameters of the log-pdf of gaussian templates, using the Cholesky factors of their covariances
+    :param covs: a (..., POIs, POIs) stack of covariance matrices
+    :return: the inverse covariances (..., POIs, POIs) and the log-determinants (...) of the covariances
+    """
+    chol = np.linalg.cholesky(covs)
+    inv_chol = np.linalg.inv(chol)
+
+    inv_covs = np.swapaxes(inv_chol, -1, -2) @ inv_chol
+    logdets = 2 * np.log(np.diagonal(chol, axis1=-2, axis2=-1)).sum(axis=-1)
+    return inv_covs, logdets
+
+
+class TemplateScorer:
+    """
+    Scores traces against the gaussian templates of the 8 rows of a column (one template per hamming weight), as
+    scipy.stats.multivariate_normal(means, covs).logpdf, for all the traces, rows and hamming weights at once.
+    """
+
+    def __init__(self, pois, means, inv_covs, logdets):
+        """
+        :param pois: the (rows, POIs) indices of the points of interest of each row
+        :param means: the (rows, HW, POIs) means of the templates
+        :param inv_covs: the (rows, HW, POIs, POIs) inverse covariances of the templates
+        :param logdets: the (rows, HW) log-determinants of the covariances
+        """
+        self.pois = np.asarray(pois)
+        self.means = np.asarray(means, np.float64)
+        self.inv_covs = np.asarray(inv_covs, np.float64)
+        self.logdets = np.asarray(logdets, np.float64)
+
+    def score(self, traces):
+        """
+        :param traces: a (traces, samples) matrix
+        :return: the (traces, rows, HW) log-likelihoods of each trace for each row and hamming weight
+        """
+        points = np.asarray(traces)[:, self.pois]  # (traces, rows, POIs)
+
+        diff = points[:, :, None, :] - self.means[None]
+        mahalanobis = np.einsum('trhp,rhpq,trhq->trh', diff, self.inv_covs, diff)
+
+        return -0.5 * (mahalanobis + self.logdets[None] + self.pois.shape[1] * np.log(2 * np.pi))
+
+
+class Template:
+    """
+    The templates of the 8x8 (col, row) of a device, as stored in a template file: the POIs (8, 8, POIs) and, for each
+    hamming weight, the means (8, 8, 5, POIs), covariances (8, 8, 5, POIs, POIs), inverse covariances and
+    log-determinants (8, 8, 5) of the covariances.
+    """
+
+    ARRAYS = ('pois', 'means', 'covs', 'inv_covs', 'logdets')
+
+    def __init__(self, params, pois, means, covs, inv_covs, logdets):
+        self.params = params
+        self.pois = pois
+        self.means = means
+        self.covs = covs
+        self.inv_covs = inv_covs
+        self.logdets = logdets
+
+    @staticmethod
+    def from_models(params, models):
+        """Creates a template from a list (col) of lists (row) of (POIs, means, covs), as fitted by create_model"""
+        pois = np.array([[p for p, _, _ in col] for col in models], np.int64)
+        means = np.array([[m for _, m, _ in col] for col in models], np.float64)
+        covs = np.array([[c for _, _, c in col] for col in models], np.float64)
+        inv_covs, logdets = gaussian_parameters(covs)
+        return Template(params, pois, means, covs, inv_covs, logdets)
+
+    def scorer(self, col):
+        """The TemplateScorer of the 8 rows of a column"""
+        return TemplateScorer(self.pois[col], self.means[col], self.inv_covs[col], self.logdets[col])
+
+
+def save_template(path, template: Template):
+    """
+    Writes a template file: a magic string, the length of the JSON header (8 bytes, little endian), the header (format
+    version, capture parameters, dtype/shape/offset of each array) then the raw arrays, aligned so that they can be
+    memory mapped. The file is replaced atomically, the processes that mapped its previous version keep reading it
+    """
+    arrays = {name: np.ascontiguousarray(getattr(template, name)) for name in Template.ARRAYS}
+
+    def header_bytes(offsets):
+        header = {
+            'version': TEMPLATE_VERSION,
+            'params': template.params,
+            'arrays': {name: {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offsets.get(name, 0)}
+                       for name, a in arrays.items()}
+        }
+        return json.dumps(header).encode()
+
+    def align(n):
+        return (n + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+    # the offsets are written in the header, reserve enough space for their digits
+    start = align(len(_MAGIC) + 8 + len(header_bytes({name: 10 ** 15 for name in arrays})))
+    offsets = {}
+    for name, a in arrays.items():
+        offsets[name] = start
+        start = align(start + a.nbytes)
+
+    header = header_bytes(offsets)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(_MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for name, a in arrays.items():
+            f.seek(offsets[name])
+            f.write(a.tobytes())
+    os.replace(path + '.tmp', path)
+
+
+def load_template(path) -> Template:
+    """Loads a template file written by save_template, its arrays are read-only memory maps of the file"""
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f"{path} is not a template file. If it is a pickled template from an older version, "
+                             f"convert it with attacks.photonbeetle.templates.convert_pickled_template")
+        header = json.loads(f.read(int.from_bytes(f.read(8), 'little')))
+
+    if header['version'] != TEMPLATE_VERSION:
+        raise ValueError(f"unsupported template version {header['version']} (expected {TEMPLATE_VERSION})")
+
+    arrays = {name: np.memmap(path, mode='r', dtype=np.dtype(a['dtype']), shape=tuple(a['shape']), offset=a['offset'])
+              for name, a in header['arrays'].items()}
+    return Template(header['params'], **arrays)
+
+
+def convert_pickled_template(pickled_path, path):
+    """Converts a pickled template ({'params', 'templates'} dict) to a template file. Only use on trusted files."""
+    with open(pickled_path, 'rb') as f:
+        data = pickle.load(f)
+    save_template(path, Template.from_models(data['params'], data['templates']))
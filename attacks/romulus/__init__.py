@@ -3,6 +3,7 @@ from argparse import ArgumentParser
 from util import select
 
 from runners.cw_basic import WrappedChipWhisperer
+from runners.cw_simulated import SimulatedChipWhisperer
 import chipwhisperer as cw
 
 sources = ['xmega', 'stm32', 'emulator']
@@ -15,6 +16,7 @@ def init_subcommand(subparser: ArgumentParser):
     subparser.add_argument('--save', dest='save', metavar='project name', default=None, help='save the generated data, traces, oracle response')
     subparser.add_argument('--load', dest='load', metavar='project name', default=None, help='the name of a saved project to load (ignores source)')
     subparser.add_argument('-n', '--num-traces', dest='num_traces', type=int, default=None, help='override the number of traces to capture')
+    subparser.add_argument('--early-stop', dest='early_stop', type=int, default=None, metavar='batches', help='stop capturing once the best guesses for the 16 key bytes have been stable for this many batches of traces (the number of traces becomes a maximum)')
     subparser.add_argument('--faster-first-subkey', dest='faster_first_subkey', action='store_const', const=True, default=False, help='use a faster but experimental method to confirm the correctness of the first half of the key')
 
 def run(args):
@@ -24,7 +26,11 @@ def run(args):
     from .attack import attack
     attack(source, verifier, args.load, args.save, args)
 
-def init_wrap():
+def init_wrap(simulation=None):
+    """:param simulation: if given, the options (noise, jitter, seed) of a simulated board (see SimulatedChipWhisperer)"""
+    if simulation is not None:
+        return SimulatedChipWhisperer(alg='romulusn', platform='CWLITEARM', **simulation)
+
     # This works for benchmarks but not anything else
     return WrappedChipWhisperer(
         alg='romulusn',
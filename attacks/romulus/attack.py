@@ -2,16 +2,21 @@ import sys
 
 from typing import Optional
 
-import lascar
-import itertools
-
 from tqdm import tqdm
 
-from .classifiers import round_2_model, round_1_model, compute_initial_state
+from .classifiers import round_2_hypotheses, round_1_inputs, round_1_table, round_2_inputs, round_2_table, \
+    compute_initial_states
 from .constants import NP_TWEAKEY_P
 import numpy as np
 
 from util import constants
+from util.cpa import BinnedCpaEngine, EarlyStopping, correlate, run_engines
+from util.enumeration import enumerate_keys
+from util.values import as_values, field, pack_values
+from runners.parallel import match_ciphertext
+
+# Maximum number of candidates for the end of the key tested in Step 4
+MAX_FINAL_CANDIDATES = 5120
 
 
 def attack(traces_source, verifier_enc, load_from, save_to, args, wrap=None):
@@ -23,13 +28,14 @@ def attack(traces_source, verifier_enc, load_from, save_to, args, wrap=None):
     get_num_samples = lambda x: x
     thresholds = None
     threshold = 0.5
+    verifier = None
 
     if args.num_traces is not None and args.num_traces > 0:
         print(f"INFO: overriding number of traces to {args.num_traces}")
         get_num_samples = lambda _: args.num_traces
 
     if load_from:
-        capture_fn = lambda: print("FATAL: called capture but load_from is present. This should not happen")
+        capture_fn = lambda on_batch=None: print("FATAL: called capture but load_from is present. This should not happen")
         enc_oracle_fn = lambda nonce, pt: print("FATAL: called oracle but load_from is present. This should not happen")
 
         threshold = 0.3 if traces_source == 'stm32' else 0.6
@@ -39,13 +45,13 @@ def attack(traces_source, verifier_enc, load_from, save_to, args, wrap=None):
         from attacks.romulus.runners.cw_xmega import capture_traces as capture
         from attacks.romulus.runners.cw_xmega import encrypt as enc
 
-        capture_fn = lambda: capture(key, n_samples=get_num_samples(600))
+        capture_fn = lambda on_batch=None: capture(key, n_samples=get_num_samples(600), on_batch=on_batch)
         enc_oracle_fn = lambda nonce, pt: enc(key, pt, nonce)
 
     elif traces_source == 'stm32':
         if wrap is not None:
-            def capture(key, n_samples):
-                return wrap.capture_traces(key, n_samples, cap_num_windows=1, cap_first_offset=0)
+            def capture(key, n_samples, on_batch=None):
+                return wrap.capture_traces(key, n_samples, cap_num_windows=1, cap_first_offset=0, on_batch=on_batch)
 
             def enc(key, plaintext, nonce=None, ad=''):
                 return wrap.encrypt(key, plaintext, nonce, ad)
@@ -55,7 +61,7 @@ def attack(traces_source, verifier_enc, load_from, save_to, args, wrap=None):
             from attacks.romulus.runners.cw_arm import capture_traces as capture
 
         enc_oracle_fn = lambda nonce, pt: enc(key, pt, nonce)
-        capture_fn = lambda: capture(key, n_samples=get_num_samples(2000))
+        capture_fn = lambda on_batch=None: capture(key, n_samples=get_num_samples(2000), on_batch=on_batch)
 
         threshold = 0.3
         thresholds = [0.20 if i == 5 else 0.35 for i in range(8)]
@@ -63,7 +69,11 @@ def attack(traces_source, verifier_enc, load_from, save_to, args, wrap=None):
         from attacks.romulus.runners.emulator import capture_traces as capture
         from attacks.romulus.runners.emulator import encrypt as enc
 
-        capture_fn = lambda: capture(key, n_samples=get_num_samples(500), instr_count=30000)
+        # nothing before nonce_encryption depends on the nonce, each worker only emulates this prefix once. The traces
+        # start with the first block cipher call, which holds the attacked rounds
+        capture_fn = lambda on_batch=None: capture(key, n_samples=get_num_samples(500), instr_count=30000,
+                                                   snapshot_at='nonce_encryption',
+                                                   trace_window=('skinny_128_384_plus_enc', None), on_batch=on_batch)
         enc_oracle_fn = lambda nonce, pt: enc(key, pt, nonce)
 
         threshold = 0.5
@@ -81,7 +91,9 @@ def attack(traces_source, verifier_enc, load_from, save_to, args, wrap=None):
         enc_fn = enc
     elif verifier_enc == 'native':
         from attacks.romulus.runners.native import encrypt as enc
+        from runners.parallel import shared_verifier
         enc_fn = enc
+        verifier = shared_verifier("bin/romulusn.so")
     else:
         sys.exit(0)
 
@@ -90,7 +102,8 @@ def attack(traces_source, verifier_enc, load_from, save_to, args, wrap=None):
         threshold = args.threshold
 
     found_key, real_key, num_iterations = _attack(capture_fn, enc_oracle_fn, enc_fn, threshold, load_from, save_to, real_key=key,
-                                                  thresholds=thresholds, faster_first_subkey=args.faster_first_subkey if args.faster_first_subkey is not None else False)
+                                                  thresholds=thresholds, faster_first_subkey=args.faster_first_subkey if args.faster_first_subkey is not None else False,
+                                                  verifier=verifier, early_stop=args.early_stop)
 
     # Has the function returned a new real key? (loaded from a previous run)
     key = real_key if real_key is not None else key
@@ -108,35 +121,24 @@ def attack(traces_source, verifier_enc, load_from, save_to, args, wrap=None):
         return constants.STATUS_NOT_FOUND, num_iterations
 
 
-def _attack(capture, enc_oracle, enc, threshold, load_from=None, save_to=None, real_key=None, thresholds=None, fail_fast=False, faster_first_subkey=False) \
-        -> tuple[Optional[bytes], Optional[bytes], int]:
-    """Execute the attack"""
+def _attack(capture, enc_oracle, enc, threshold, load_from=None, save_to=None, real_key=None, thresholds=None, fail_fast=False, faster_first_subkey=False,
+            verifier=None, early_stop=None) -> tuple[Optional[bytes], Optional[bytes], int]:
+    """
+    Execute the attack (the final key candidates are tested on verifier if given, otherwise with enc)
+
+    If early_stop is given, the CPA runs during the capture, which stops once the best guesses for the 16 bytes of the
+    key have been stable for early_stop batches of traces (see _EarlyStopping).
+    """
 
     if load_from is None:
         # Capture the power traces from the board
         print("Step 1: acquire traces")
 
-        container = capture()
+        container = capture(on_batch=_EarlyStopping(early_stop, threshold, thresholds) if early_stop else None)
 
         # Compute the initial state of Skinny, as it can depend on the nonce depending on the chosen attack point
-        v = container.values
-        new_v = []
-        for index, arr in enumerate(v):
-            if len(arr) != 2:
-                # No AD, fallback
-                nonce = arr
-                iv = compute_initial_state(np.zeros(16, np.uint8), np.zeros(16, np.uint8))
-            else:
-                nonce, ad = arr
-                a0 = ad[:16]
-                a1 = ad[16:]
-                iv = compute_initial_state(a0, a1)
-
-            # set the user value to (nonce, initial vector)
-            new_v.append((nonce, iv))
-
-        container.values = np.array(new_v)
-
+        # set the user value to (nonce, initial vector)
+        container.values = _nonce_iv(container.values)
 
         nonce = b'\x00' * 16
         oracle = enc_oracle(nonce, '')
@@ -150,7 +152,7 @@ def _attack(capture, enc_oracle, enc, threshold, load_from=None, save_to=None, r
         from lascar import TraceBatchContainer
 
         result = load(load_from)
-        container = TraceBatchContainer(np.array(result["traces"]), np.array(result["inputs"]))
+        container = TraceBatchContainer(np.array(result["traces"]), _nonce_iv(result["inputs"]))
         nonce = result["pt"]
         oracle = result["ct"]
         real_key = result["key"]
@@ -174,6 +176,7 @@ def _attack(capture, enc_oracle, enc, threshold, load_from=None, save_to=None, r
     end = None
     selected_key_bytes = [0 for _ in range(8)]
     num_iterations = 0  # for benchmarking
+    round_2_cache = {}  # round 2 results of each byte, see _find_second_half_candidates
     while len(wrong_elements) != 0:
         num_iterations += 1
         # determine key
@@ -181,8 +184,9 @@ def _attack(capture, enc_oracle, enc, threshold, load_from=None, save_to=None, r
 
         print("Starting! wrongs=", wrong_elements, "selected_key_bytes=", selected_key_bytes, "key=", key.hex())
 
-        end, wrong_elements = _find_second_half_candidates(container, key_start=key, keep_N=10, real_key=real_key,
-                                                           correlation_threshold=threshold, thresholds=thresholds)
+        end, wrong_elements, end_scores = _find_second_half_candidates(container, key_start=key, keep_N=10, real_key=real_key,
+                                                           correlation_threshold=threshold, thresholds=thresholds,
+                                                           cache=round_2_cache)
         print("Done! n_wrongs=", wrong_elements)
 
         if len(wrong_elements) > 0:
@@ -207,53 +211,108 @@ def _attack(capture, enc_oracle, enc, threshold, load_from=None, save_to=None, r
     print("Step 4: find the final key")
     test_fn = lambda k: enc(k, '', nonce) == oracle
 
-    # Test the vector we found
-    test_key = key_start + bytes([x[0] for x in end])
+    # Test the candidates for the end of the key by decreasing sum of correlations, starting with the vector we found
+    candidates = (key_start + bytes(sel) for sel in enumerate_keys(end, end_scores, limit=MAX_FINAL_CANDIDATES))
     found_key = None
-    keep_N_vect = [2, 2, 4, 4, 2, 2, 10, 2]
-    if test_fn(test_key):
-        found_key = test_key
-
-    for max_wrong_bytes in range(8):
-        # which byte will we check
-        selection_vectors = itertools.combinations(range(8), max_wrong_bytes)
-
-        for sel_vector in tqdm(selection_vectors):
-            if sel_vector == (): continue
-            values_vector_partial = itertools.product(*[range(keep_N_vect[i]) for i in sel_vector])  # itertools.combinations_with_replacement(range(4), max_wrong_bytes)
-
-            for value_vector in values_vector_partial:
-                sel = []
-                for i in range(8):
-                    if i in sel_vector:
-                        index = sel_vector.index(i)
-                        sel.append(end[i][value_vector[index]])
-                    else:
-                        sel.append(end[i][0])
-                key = key_start + bytes(sel)
-
-                for retries in range(10):
-                    try:
-                        if test_fn(key):
-                            found_key = key
-                        break
-                    except AttributeError:
-                        print("\t\tAttempt", retries+1, "failed, retrying...")
-                        pass
-
-                if found_key is not None: break
-            if found_key is not None: break
+
+    if verifier is not None:
+        found_key, _ = verifier.search(candidates, match_ciphertext, '', nonce, oracle)
+        return found_key, real_key, num_iterations
+
+    for key in tqdm(candidates, total=MAX_FINAL_CANDIDATES):
+        for retries in range(10):
+            try:
+                if test_fn(key):
+                    found_key = key
+                break
+            except AttributeError:
+                print("\t\tAttempt", retries+1, "failed, retrying...")
+                pass
+
         if found_key is not None: break
 
     return found_key, real_key, num_iterations
 
 
+def _nonce_iv(values):
+    """Converts the values of the captured traces (nonce, and ad if any) to structured (nonce, iv) values"""
+    values = np.asarray(values)
+    if values.dtype.names is None and values.ndim == 3:
+        # project saved before the values were structured, as (nonce, iv) pairs
+        return pack_values(nonce=values[:, 0], iv=values[:, 1])
+
+    values = as_values(values)
+    if 'iv' in values.dtype.names:
+        return values
+
+    # No AD, fallback
+    ad = values['ad'] if 'ad' in values.dtype.names else np.zeros((len(values), 32), np.uint8)
+
+    return pack_values(nonce=values['nonce'], iv=compute_initial_states(ad))
+
+
+class _EarlyStopping:
+    """
+    Online CPA of rounds 1 and 2, stops the capture once the best guesses of the 16 bytes of the key are stable.
+
+    Round 2 depends on the 8 first bytes, its engines are only created once the round 1 guesses are stable, and fed the
+    traces captured so far. From then on they get every batch, and are created again from all the traces whenever the
+    round 1 guesses change.
+    """
+
+    def __init__(self, patience, threshold, thresholds=None):
+        """
+        :param patience: the number of consecutive batches for which the best guesses must be stable
+        :param threshold, thresholds: the minimum round 2 correlations, as in _find_second_half_candidates
+        """
+        self.patience = patience
+        self.round_2_thresholds = thresholds if thresholds is not None else [threshold] * 8
+
+        self.round_1 = EarlyStopping([
+            BinnedCpaEngine(f'cpa{byte}', lambda values, index=byte: round_1_inputs(values, index), round_1_table)
+            for byte in range(8)
+        ], [0] * 8, patience)
+        self.round_2 = None
+        self.key_start = None
+        self.batches = []
+
+    def _round_2(self, key_start):
+        key_four = np.frombuffer(key_start, np.uint8)
+        engines = [
+            BinnedCpaEngine(f'cpa{byte + 8}', lambda values, index=byte: round_2_inputs(
+                field(values, 'nonce'), field(values, 'iv'), index, key_four), round_2_table)
+            for byte in range(8)
+        ]
+        return EarlyStopping(engines, self.round_2_thresholds, self.patience)
+
+    def __call__(self, leakages, values) -> bool:
+        values = _nonce_iv(values)
+        self.batches.append((leakages, values))
+        round_1_stable = self.round_1(leakages, values)
+
+        if self.round_2 is None and not round_1_stable:
+            return False
+
+        key_start = bytes(int(guess) for guess in self.round_1.best_guesses)
+        if key_start != self.key_start:
+            # round 2 is built again from all the traces captured so far, with the new guesses of round 1
+            self.key_start = key_start
+            self.round_2 = self._round_2(key_start)
+            for batch_leakages, batch_values in self.batches[:-1]:
+                for engine in self.round_2.engines:
+                    engine.update(batch_leakages, batch_values)
+
+        # every batch is fed to round 2, even while round 1 is not stable
+        return self.round_2(leakages, values) and round_1_stable
+
+
 def _process_results(results, keep_N, correlation_threshold=0, thresholds=None):
     """
-    Given the results of the CPA, output an array of arrays sorted by most likely candidate first and an array of
-    likely incorrect bytes
+    Given the results of the CPA, output an array of arrays sorted by most likely candidate first, an array of
+    likely incorrect bytes and the correlations of the candidates
     """
     possible_keys = []
+    scores = []
     likely_wrong = set()
 
     # plot(results[0])
@@ -271,22 +330,47 @@ def _process_results(results, keep_N, correlation_threshold=0, thresholds=None):
             likely_wrong.add(index)
 
         possible_keys.append(rMax.argsort()[::-1][:keep_N])
+        scores.append(rMax[possible_keys[-1]])
 
-    return possible_keys, likely_wrong
+    return possible_keys, likely_wrong, scores
+
+
+def _round_2_dependencies(index):
+    """Positions of the bytes of the key start that byte index of round 2 depends on (see round_2_model)"""
+    if index >= 4:
+        # row1 also depends on the (shifted) row1 of round 1
+        return index % 4, (index - 2) % 4 + 4
+    return index % 4,
 
 
 def _find_second_half_candidates(container, key_start: bytes, keep_N, correlation_threshold, real_key=None,
-                                 bytes_to_search=range(8), thresholds=None):
-    eng = [
-        lascar.CpaEngine(f'cpa{byte}',
-                         lambda nonce, guess, index=byte: round_2_model(nonce, guess, index, key_start),
-                         range(256))
-        for byte in bytes_to_search
-    ]
-    lascar.Session(container, engines=eng).run(batch_size="auto")
-    results = [engine.finalize() for engine in eng]
-    possible_keys, wrongs = _process_results(results, keep_N, correlation_threshold, thresholds)
+                                 bytes_to_search=range(8), thresholds=None, cache=None):
+    """
+    Runs the round 2 CPA for the given start of the key.
+
+    If a cache dictionary is given, the results of each byte are stored in it, keyed by the bytes of key_start that the
+    byte depends on. Only the bytes whose inputs changed since a previous call are then recomputed.
+    """
+    nonces, initials = field(container.values, 'nonce'), field(container.values, 'iv')
+    key_four = np.frombuffer(key_start, np.uint8)
+
+    results = []
+    for byte in bytes_to_search:
+        cache_key = (byte,) + tuple(key_start[i] for i in _round_2_dependencies(byte))
+
+        if cache is not None and cache_key in cache:
+            results.append(cache[cache_key])
+            continue
+
+        result = correlate(round_2_hypotheses(nonces, initials, byte, key_four), container.leakages)
+        # _process_results only uses the highest correlation of each guess, no need to keep the full matrix
+        result = np.abs(result).max(axis=1, keepdims=True)
+        if cache is not None:
+            cache[cache_key] = result
+        results.append(result)
+    possible_keys, wrongs, scores = _process_results(results, keep_N, correlation_threshold, thresholds)
     reorder = [[] for _ in range(8)]
+    reorder_scores = [[] for _ in range(8)]
 
     # for the last 4 bytes of the key, we don't use exactly key[index + 4] but key[(index + 2) % 4 + 4]
     nwrongs = []
@@ -302,6 +386,7 @@ def _find_second_half_candidates(container, key_start: bytes, keep_N, correlatio
             print("WARNING: likely wrong value for byte", i, "of the key start (affects byte", NP_TWEAKEY_P[i],
                   "of the rest)")
         reorder[NP_TWEAKEY_P[i] - 8] = possible_keys[pos]
+        reorder_scores[NP_TWEAKEY_P[i] - 8] = scores[pos]
     # while -1 in reorder: reorder.remove(-1)
 
     if real_key is not None:
@@ -309,19 +394,17 @@ def _find_second_half_candidates(container, key_start: bytes, keep_N, correlatio
             print("Possibilities for byte", index + 8, [hex(x) for x in r])
             print("Actual               :", hex(real_key[index + 8]), "\tin possibilities?", real_key[index + 8] in r)
 
-    return reorder, wrongs
+    return reorder, wrongs, reorder_scores
 
 
 def _find_first_half_candidates(container, keep_N, real_key=None, fail_fast=False):
+    # round 1 only depends on one byte of (nonce, iv) per key byte, so the traces can be binned by that byte
     eng = [
-        lascar.CpaEngine(f'cpa{byte}',
-                         lambda nonce, guess, index=byte: round_1_model(nonce, guess, index),
-                         range(256))
+        BinnedCpaEngine(f'cpa{byte}', lambda values, index=byte: round_1_inputs(values, index), round_1_table)
         for byte in range(8)
     ]
-    lascar.Session(container, engines=eng).run(batch_size="auto")
-    results = [engine.finalize() for engine in eng]
-    possible_keys, _ = _process_results(results, keep_N)
+    results = run_engines(container, eng)
+    possible_keys, _, _ = _process_results(results, keep_N)
 
     if real_key is not None:
         for index, r in enumerate(possible_keys):
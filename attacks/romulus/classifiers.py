@@ -1,6 +1,7 @@
 from lascar.tools.leakage_model import hamming
 from numba import njit
 from .constants import *
+from util.cpa import xor_model_table
 
 
 def init_lfsr() -> []:
@@ -46,6 +47,20 @@ def compute_initial_state(ad0, ad1):
     return np.array(initial)
 
 
+# compute_initial_state is sbox_8[ad0 ^ ad1] xored with a constant (the counter, round constant and tweakey bytes)
+_INITIAL_STATE_CONSTANT = (compute_initial_state(np.zeros(16, np.uint8), np.zeros(16, np.uint8)) ^ sbox_8[0]).astype(np.uint8)
+_SBOX_U8 = sbox.astype(np.uint8)
+
+
+def compute_initial_states(ad):
+    """
+    Batched version of compute_initial_state
+    :param ad: a (traces, 32) array, the two first blocks of associated data of each trace
+    :return: the (traces, 16) uint8 array of initial states
+    """
+    ad = np.asarray(ad, np.uint8)
+    return _SBOX_U8[ad[:, :16] ^ ad[:, 16:32]] ^ _INITIAL_STATE_CONSTANT
+
 
 @njit
 def round_1_model(pair, guess, index) -> int:
@@ -60,6 +75,27 @@ def round_1_model(pair, guess, index) -> int:
     return hamming(sbox[round0])
 
 
+# Hamming weight of the output of the sbox, for each input
+HW_SBOX = np.array([hamming(s) for s in sbox_8])
+
+# Hypotheses of round_1_model for all (guess, input byte) pairs, see round_1_inputs
+round_1_table = xor_model_table(HW_SBOX)
+
+# Hypotheses of round_2_model for all (guess, input byte) pairs, see round_2_inputs
+round_2_table = HW_SBOX[np.bitwise_xor.outer(np.asarray(LFSR_TK3), np.arange(256))]
+
+
+def round_1_inputs(values, index):
+    """Computes, for each trace, the byte that round_1_model xors with the guess (values: see util.values)"""
+    nonces, initials = values['nonce'], values['iv']
+
+    inputs = initials[:, index] ^ nonces[:, index]
+    if index >= 4:
+        inputs ^= initials[:, (index - 1) % 4 + 8]
+
+    return inputs
+
+
 @njit
 def round_2_model(pair, guess, index, key_four) -> int:
     """
@@ -130,3 +166,54 @@ def round_2_model(pair, guess, index, key_four) -> int:
 
     res = sbox[add_key]
     return hamming(res)
+
+
+@njit
+def round_2_inputs(nonces, initials, index, key_four):
+    """
+        Computes, for each trace, the value of round_2_model's state just before the round key is added.
+
+        The hypothesis of a trace is then the hamming weight of sbox[input ^ LFSR_TK3[guess]].
+    """
+    n = nonces.shape[0]
+    inputs = np.empty(n, np.int64)
+    round_0_index = index % 4
+
+    for t in range(n):
+        # int64, as numba types uint8 ^ uint8 as uint64, which does not mix with the constants
+        round_0_result = np.int64(initials[t, round_0_index] ^ key_four[round_0_index] ^ nonces[t, round_0_index])
+        if index == 2:
+            round_0_result ^= 0x2
+
+        state = sbox[round_0_result]
+        if index == 0:
+            state ^= (RC[1] & 0xf)
+
+        state ^= LFSR_TK2[nonces[t, NP_TWEAKEY_P[index]]]
+
+        if index >= 4:
+            round_0_row_1_index = (index - 2) % 4 + 4
+            round_0_row_2_index = (index - 3) % 4 + 8
+            round_0_row_1 = initials[t, round_0_row_1_index] ^ key_four[round_0_row_1_index] ^ nonces[t, round_0_row_1_index]
+            state ^= sbox[initials[t, round_0_row_2_index] ^ round_0_row_1]
+
+        inputs[t] = state
+
+    return inputs
+
+
+@njit
+def round_2_hypotheses(nonces, initials, index, key_four):
+    """
+        Batched version of round_2_model.
+
+        :return: a (traces, 256) matrix, with the hypothesis of each trace (row) for each guess (column)
+    """
+    inputs = round_2_inputs(nonces, initials, index, key_four)
+    hypotheses = np.empty((inputs.shape[0], 256), np.uint8)
+
+    for t in range(inputs.shape[0]):
+        for guess in range(256):
+            hypotheses[t, guess] = HW_SBOX[inputs[t] ^ LFSR_TK3[guess]]
+
+    return hypotheses
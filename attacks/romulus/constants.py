@@ -23,3 +23,16 @@ NP_TWEAKEY_P = np.array([9, 15, 8, 13, 10, 14, 12, 11, 0, 1, 2, 3, 4, 5, 6, 7])
 
 # Round constants (only the first two are needed)
 RC = np.array([0x01, 0x03])
+
+
+def _lfsr_tk2(x):
+    return ((x << 1) & 0xFE) ^ ((x >> 7) & 0x01) ^ ((x >> 5) & 0x01)
+
+
+def _lfsr_tk3(x):
+    return ((x >> 1) & 0x7F) ^ ((x << 7) & 0x80) ^ ((x << 1) & 0x80)
+
+
+# Tweakey LFSRs applied to the TK2 (nonce) and TK3 (key) bytes between two rounds, as look up tables
+LFSR_TK2 = np.array([_lfsr_tk2(x) for x in range(256)])
+LFSR_TK3 = np.array([_lfsr_tk3(x) for x in range(256)])
@@ -14,8 +14,8 @@ def reset_target(scope):
     return wrap.reset_target()
 
 
-def capture_traces(key, n_samples):
-    return wrap.capture_traces(key, n_samples, cap_num_windows=1, cap_first_offset=0)
+def capture_traces(key, n_samples, on_batch=None):
+    return wrap.capture_traces(key, n_samples, cap_num_windows=1, cap_first_offset=0, on_batch=on_batch)
 
 
 def encrypt(key, plaintext, nonce=None, ad=''):
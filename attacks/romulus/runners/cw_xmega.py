@@ -14,8 +14,8 @@ def reset_target(scope):
     return wrap.reset_target()
 
 
-def capture_traces(key, n_samples):
-    return wrap.capture_traces(key, n_samples, cap_num_windows=2, cap_first_offset=25000)
+def capture_traces(key, n_samples, on_batch=None):
+    return wrap.capture_traces(key, n_samples, cap_num_windows=2, cap_first_offset=25000, on_batch=on_batch)
                                # pt_gen=(lambda: np.random.randint(0, 256, 16, np.uint8)))
 
 
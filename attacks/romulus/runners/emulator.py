@@ -1,37 +1,80 @@
-from lascar import TraceBatchContainer
-from rainbow.utils import hw
-
+from runners.emu_farm import shared_farm
 from runners.emu_wrappers.x86 import x86
 import numpy as np
-from tqdm import tqdm
 
-print("Initializing emulator...")
-rt = x86("romulusn", 16, 16, sca=True)
+from util.values import pack_values
 
+# emulator used for the encryptions, the traces are emulated by the workers of a farm (see capture_traces)
+rt = None
 
-def capture_traces(key, n_samples=200, instr_count=15000, start_at=0):
-    print("Acquiring", n_samples, "traces...")
-    traces = []
-    nonces = []
-    rt.emu.trace = True
-    rt.emu.mem_trace = True
-    rt.emu.trace_regs = True
 
-    for i in tqdm(range(n_samples)):
-        nonce = np.random.randint(0, 256, 16, np.uint8)
-        _, _, _, r = rt.encrypt('', '', key, nonce.tobytes(), cnt=instr_count)
-        r = r[start_at:]
-        leakage = np.array([hw(i) for i in r]) + np.random.normal(0, 1.0, (len(r)))
+def _runtime():
+    global rt
+    if rt is None:
+        print("Initializing emulator...")
+        rt = x86("romulusn", 16, 16, sca=True)
+    return rt
+
+
+def _emulate(wrapper, key, n_samples, rng, out, instr_count, start_at, snapshot_at, trace_window):
+    """Emulates a shard of traces on the emulator of a worker, into the rows given by out (see EmulatorFarm.capture)"""
+    nonces = rng.integers(0, 256, (n_samples, 16), np.uint8)
+    traces = None
+    snapshot = None
+
+    if snapshot_at is not None:
+        # the prefix of the encryption is the same for all the traces, it is only emulated once (without tracing)
+        wrapper.set_trace(False)
+        wrapper.set_mem_trace(False)
+        wrapper.set_trace_regs(False)
+        snapshot = wrapper.snapshot(snapshot_at, '', '', key, nonces[0].tobytes())
+
+    wrapper.set_trace(True)
+    wrapper.set_mem_trace(True)
+    wrapper.set_trace_regs(True)
+    wrapper.set_trace_window(*trace_window)
+
+    for i, nonce in enumerate(nonces):
+        if snapshot is not None:
+            _, _, _, r = wrapper.encrypt_from_snapshot(snapshot, nonce.tobytes(), cnt=instr_count)
+        else:
+            _, _, _, r = wrapper.encrypt('', '', key, nonce.tobytes(), cnt=instr_count)
+
+        if traces is None:
+            # the length of the traces is given by the first one
+            traces = out(len(r) - start_at)
+        wrapper.leakage(r, start_at, out=traces[i])
+
+    # gaussian noise, for the whole shard at once
+    traces += rng.standard_normal(traces.shape, np.float32)
+
+    return traces, pack_values(nonce=nonces)
+
+
+def capture_traces(key, n_samples=200, instr_count=15000, start_at=0, on_batch=None, batch_size=50, workers=None,
+                   seed=None, snapshot_at=None, trace_window=(None, None)):
+    """
+    Emulates the traces on a pool of processes, each with its own x86 emulator
+    :param on_batch: called with each batch of batch_size traces, stops the capture if it returns True
+    :param workers: the number of processes (by default: number of cores)
+    :param seed: the seed of the nonces and noise, the same seed gives the same traces for any number of workers
+    :param snapshot_at: if given, a code address or function name before which the encryption does not depend on the
+        nonce. Each worker emulates this prefix once and starts every trace from a snapshot (instr_count and start_at
+        then count from this address)
+    :param trace_window: the (start, stop) code addresses or function names between which the traces are recorded, the
+        emulation stops at stop (see EmulatorWrapper.set_trace_window)
+    """
+    print("Acquiring", n_samples, "traces...")
+    farm = shared_farm('x86', "romulusn", 16, 16, sca=True, workers=workers)
 
-        traces.append(leakage)
-        nonces.append(nonce)
+    return farm.capture(_emulate, key, n_samples, instr_count, start_at, snapshot_at, trace_window, seed=seed,
+                        shard_size=batch_size, on_shard=on_batch)
 
-    return TraceBatchContainer(np.array(traces), np.array(nonces))
 
 def encrypt(key, plaintext, nonce=None, ad=''):
     if nonce is None:
         nonce = np.random.randint(0, 256, 16, np.uint8).tobytes()
 
-    ct_len, ct = rt.encrypt(plaintext, ad, key, nonce)
+    ct_len, ct = _runtime().encrypt(plaintext, ad, key, nonce)
 
     return ct_len, ct
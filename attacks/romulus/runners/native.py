@@ -1,7 +1,5 @@
-from runners.native import NativeRunner
-
-runner = NativeRunner("bin/romulusn.so")
+from runners.native import native_runner
 
 
 def encrypt(key, plaintext, nonce=None, adata=''):
-    return runner.encrypt(key, plaintext, nonce, adata)
+    return native_runner("bin/romulusn.so").encrypt(key, plaintext, nonce, adata)
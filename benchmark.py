@@ -24,6 +24,13 @@ if __name__ == "__main__":
     attacks = list(ATTACKS.keys())
     parse.add_argument('-n', dest='num_run', default=100, type=int, help='number of data to collect for each parameters combination')
 
+    parse.add_argument('--simulate', dest='simulate', action='store_const', const=True, default=False,
+                       help='run the attack on a simulated board instead of a ChipWhisperer (see runners/cw_simulated.py)')
+    parse.add_argument('--noise', dest='noise', type=float, default=0.25,
+                       help='standard deviation of the noise of the simulated traces')
+    parse.add_argument('--jitter', dest='jitter', type=int, default=0,
+                       help='maximum shift (in samples) of the leakage of the simulated traces')
+
     parse.add_argument('attack', help='the name of the attack to benchmark', choices=attacks)
     parse.add_argument('project', help='the name of the project to load/save')
 
@@ -70,8 +77,11 @@ if __name__ == "__main__":
             pickle.dump(state, f)
 
     start_round = len(project_data["rounds"])
-    input("Please connect the board and press enter.")
-    wrap = pkg.init_wrap()
+    if args.simulate:
+        wrap = pkg.init_wrap({'noise': args.noise, 'jitter': args.jitter})
+    else:
+        input("Please connect the board and press enter.")
+        wrap = pkg.init_wrap()
     print("")
     print("")
 
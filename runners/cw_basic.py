@@ -9,6 +9,7 @@ import os.path
 import re
 
 from util import to_bytes
+from util.values import pack_values
 
 
 class WrappedChipWhisperer:
@@ -52,7 +53,8 @@ class WrappedChipWhisperer:
 
     def capture_traces(self, key, n_samples, cap_window_len=24000, cap_num_windows=5, cap_first_offset=0,
                        nonce_gen=(lambda: np.random.randint(0, 256, 16, np.uint8)), silent=False,
-                       pt_gen=None, ad_gen=None, cap_total_len=None, operation='n'):
+                       pt_gen=None, ad_gen=None, cap_total_len=None, operation='n', on_batch=None, batch_size=100,
+                       out=None, dtype=np.float32):
         """
 
         :param key:
@@ -67,9 +69,27 @@ class WrappedChipWhisperer:
         :param cap_total_len:
         :param values:
         :param operation: the targetted operation ; n for encryption, d for decryption
-        :return:
+        :param on_batch: called with the traces and values of each batch of batch_size traces. If it returns True, the
+            capture stops early (e.g. util.cpa.EarlyStopping)
+        :param batch_size:
+        :param out: a (n_samples, length) array to capture the traces into, length being cap_window_len * cap_num_windows
+            bounded by cap_total_len. By default, a new array of the given dtype is allocated
+        :param dtype: the dtype of the traces when out is not given. Floating dtypes store the scaled samples, integer
+            dtypes (e.g. np.int16) the raw ADC codes
+        :return: a container whose values are structured (see util.values), with a nonce field and the pt and ad fields
+            when pt_gen and ad_gen are given. Its traces are a view of out (or of the allocated array), up to the number
+            of captured traces
         """
         cap_len = cap_window_len * cap_num_windows
+        if cap_total_len is not None:
+            cap_len = min(cap_len, cap_total_len)
+
+        if out is None:
+            out = np.empty((n_samples, cap_len), dtype)
+        elif out.shape != (n_samples, cap_len):
+            raise ValueError(f"the capture buffer has shape {out.shape}, expected {(n_samples, cap_len)}")
+        as_int = np.issubdtype(out.dtype, np.integer)
+
         target, scope = self.target, self.scope
 
         # flush output
@@ -78,8 +98,12 @@ class WrappedChipWhisperer:
         scope.adc.timeout = 2
         scope.adc.samples = cap_window_len
 
-        traces = []
-        nonces = []
+        count = 0
+        columns = {'nonce': []}
+        if pt_gen is not None:
+            columns['pt'] = []
+        if ad_gen is not None:
+            columns['ad'] = []
 
         target.set_key(key)
 
@@ -93,22 +117,22 @@ class WrappedChipWhisperer:
         ad = None
         for _ in _range:
             nonce = nonce_gen()
-            to_append = [nonce]
+            columns['nonce'].append(np.frombuffer(to_bytes(nonce, 16), np.uint8))
             # target.flush()
-            trace = np.zeros(cap_len)
+            trace = out[count]
 
             # self.reset()
 
             if pt_gen is not None:
                 # New plaintext and nonce, we need to set them
                 plaintext = to_bytes(pt_gen())
-                to_append.append(plaintext)
+                columns['pt'].append(np.frombuffer(plaintext, np.uint8))
                 self._set_pt(plaintext)
 
             if ad_gen is not None:
                 # New plaintext and nonce, we need to set them
                 ad = to_bytes(ad_gen())
-                to_append.append(ad)
+                columns['ad'].append(np.frombuffer(ad, np.uint8))
                 self._set_ad(ad)
 
             for s in range(0, cap_len, cap_window_len):
@@ -128,17 +152,22 @@ class WrappedChipWhisperer:
                 if ret:
                     raise IOError("Target timed out!")
 
-                trace[s:s + cap_window_len] = scope.get_last_trace()
+                # the last window is cut to the length of the traces
+                trace[s:s + cap_window_len] = scope.get_last_trace(as_int=as_int)[:cap_len - s]
 
                 # print(target.read())
                 while scope.adc.state: time.sleep(0.005)
 
-            traces.append(trace[:cap_total_len])
-            if len(to_append) == 1:
-                to_append = to_append[0]
-            nonces.append(to_append)
+            count += 1
+
+            if on_batch is not None and count % batch_size == 0:
+                batch = pack_values(**{name: column[-batch_size:] for name, column in columns.items()})
+                if on_batch(out[count - batch_size:count], batch):
+                    if not silent:
+                        print(f"Stopping the capture early, after {count} traces")
+                    break
 
-        return TraceBatchContainer(np.array(traces), np.array(nonces), copy=0)
+        return TraceBatchContainer(out[:count], pack_values(**columns), copy=0)
 
     def reset(self):
         self.target.simpleserial_write('r', bytes())
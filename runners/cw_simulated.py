@@ -0,0 +1,117 @@
+import numpy as np
+from lascar import TraceBatchContainer
+from tqdm import tqdm
+
+from runners.native import native_runner
+from util import to_bytes
+from util.generators import simulated_target
+from util.values import pack_values
+
+
+class SimulatedChipWhisperer:
+    """
+    Drop-in replacement of WrappedChipWhisperer that does not need a board.
+
+    The traces are gaussian noise, to which the leakage model of the target (see util/generators.py) adds the
+    intermediate values of each encryption, possibly shifted by a random jitter. The encryptions are answered by the
+    native library of the target.
+    """
+
+    def __init__(self, alg, platform='CWLITEARM', target_type=None, prog=None, noise=0.25, jitter=0, seed=None):
+        """
+        :param alg: the name of the firmware (e.g. romulusn), selects the simulated target
+        :param platform, target_type, prog: ignored, for compatibility with WrappedChipWhisperer
+        :param noise: the standard deviation of the noise, the leaked values being hamming weights (or bits)
+        :param jitter: the maximum shift (in samples) of the leakage of a trace
+        :param seed: the seed of the nonces, noise and jitter
+        """
+        print(f"Simulating {alg} ({platform}), noise {noise}, jitter {jitter}")
+        self.target = simulated_target(alg)
+        self.noise = noise
+        self.jitter = jitter
+        self.rng = np.random.default_rng(seed)
+        self.key = bytes(16)
+
+    def reset_target(self):
+        pass
+
+    def capture_traces(self, key, n_samples, cap_window_len=24000, cap_num_windows=5, cap_first_offset=0,
+                       nonce_gen=None, silent=False, pt_gen=None, ad_gen=None, cap_total_len=None, operation='n',
+                       on_batch=None, batch_size=100, out=None, dtype=np.float32):
+        """
+        Simulates the traces of WrappedChipWhisperer.capture_traces, with the same parameters
+        :param key: the key (None to keep the current one)
+        :param nonce_gen: as WrappedChipWhisperer.capture_traces, if None the nonces are random
+        :param batch_size: the number of traces simulated at once (and given to on_batch)
+        :param out, dtype: as WrappedChipWhisperer.capture_traces, integer traces are the rounded simulated samples
+        :return: a container whose values are structured (see util.values)
+        """
+        if key is not None:
+            self.set_key(key)
+
+        cap_len = cap_window_len * cap_num_windows
+        if cap_total_len is not None:
+            cap_len = min(cap_len, cap_total_len)
+
+        if out is None:
+            out = np.empty((n_samples, cap_len), dtype)
+        elif out.shape != (n_samples, cap_len):
+            raise ValueError(f"the capture buffer has shape {out.shape}, expected {(n_samples, cap_len)}")
+        columns = {'nonce': self.rng.integers(0, 256, (n_samples, 16), np.uint8) if nonce_gen is None else
+                   np.array([np.frombuffer(to_bytes(nonce_gen(), 16), np.uint8) for _ in range(n_samples)])}
+        if pt_gen is not None:
+            columns['pt'] = [np.frombuffer(to_bytes(pt_gen()), np.uint8) for _ in range(n_samples)]
+        if ad_gen is not None:
+            columns['ad'] = [np.frombuffer(to_bytes(ad_gen()), np.uint8) for _ in range(n_samples)]
+        values = pack_values(**columns)
+
+        # without on_batch, the batches only bound the memory used by the leakage models
+        step = batch_size if on_batch is not None else max(batch_size, 10000)
+        count = 0
+
+        for start in tqdm(range(0, n_samples, step), desc='Simulating traces', disable=silent):
+            end = min(start + step, n_samples)
+            self._simulate(out[start:end], values[start:end], cap_first_offset)
+            count = end
+
+            if on_batch is not None and on_batch(out[start:end], values[start:end]):
+                if not silent:
+                    print(f"Stopping the capture early, after {count} traces")
+                break
+
+        return TraceBatchContainer(out[:count], values[:count], copy=0)
+
+    def _simulate(self, out, values, offset):
+        """Writes the traces of a batch of encryptions, for a capture starting offset samples after the trigger"""
+        traces = out if out.dtype == np.float32 else np.empty(out.shape, np.float32)
+        self.rng.standard_normal(traces.shape, np.float32, out=traces)
+        traces *= self.noise
+
+        positions, leaks = self.target.leakage(self.key, values)
+        shifts = np.zeros(len(traces), np.int64)
+        if self.jitter > 0:
+            shifts = self.rng.integers(-self.jitter, self.jitter + 1, len(traces))
+
+        # position of each leak in the window, only the ones that fall in the window are added
+        indices = positions[None, :] - offset + shifts[:, None]
+        rows, cols = np.nonzero((indices >= 0) & (indices < traces.shape[1]))
+        traces[rows, indices[rows, cols]] += leaks[rows, cols]
+
+        if traces is not out:
+            out[...] = np.rint(traces) if np.issubdtype(out.dtype, np.integer) else traces
+
+    def reset(self):
+        pass
+
+    def encrypt(self, key, plaintext, nonce=None, ad=''):
+        if self.target.library is None:
+            raise ValueError("the simulated target cannot encrypt, there is no native library for it")
+
+        key = self.key if key is None else to_bytes(key, size=16)
+        if nonce is None:
+            nonce = np.random.randint(0, 256, 16, np.uint8).tobytes()
+
+        return native_runner(self.target.library).encrypt(key, plaintext, nonce, ad)
+
+    def set_key(self, key):
+        self.key = to_bytes(key, size=16)
@@ -0,0 +1,133 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from lascar import TraceBatchContainer
+from tqdm import tqdm
+
+# EmulatorWrapper of the current worker process, created once by _init_worker
+_wrapper = None
+
+
+def _init_worker(arch, alg, key_length, nonce_length, sca):
+    global _wrapper
+
+    if arch == 'x86':
+        from runners.emu_wrappers.x86 import x86 as wrapper_class
+    elif arch == 'x64':
+        from runners.emu_wrappers.x64 import x64 as wrapper_class
+    else:
+        raise ValueError('unknown architecture ' + arch)
+
+    _wrapper = wrapper_class(alg, key_length, nonce_length, sca=sca)
+
+
+def _map_traces(path, n_traces, samples):
+    """Maps the (n_traces, samples) float32 traces file of a capture, created by the first worker that maps it"""
+    size = n_traces * samples * np.dtype(np.float32).itemsize
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    try:
+        if os.fstat(fd).st_size not in (0, size):
+            raise ValueError("the shards of a capture must have traces of the same length")
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+    return np.memmap(path, np.float32, 'r+', shape=(n_traces, samples))
+
+
+def _capture_shard(capture, key, n_samples, seed, traces_file, start, args):
+    """
+    Emulates a shard on a worker, its traces are written to the rows start to start + n_samples of the traces file
+    :return: the values of the traces and their number of samples
+    """
+    path, n_traces = traces_file
+    out = lambda samples: _map_traces(path, n_traces, samples)[start:start + n_samples]
+
+    traces, values = capture(_wrapper, key, n_samples, np.random.default_rng(seed), out, *args)
+    return values, traces.shape[1]
+
+
+class EmulatorFarm:
+    """
+    Emulates traces on a persistent pool of processes, each with its own emulator (runners/emu_wrappers).
+
+    The traces are generated by shards of a fixed size, each with its own seed derived from the seed of the capture, so
+    that a capture only depends on its seed (and not on the number of workers or on the scheduling of the shards).
+
+    The workers write the traces of their shard to their rows of a single file mapped by all the processes (in the page
+    cache), which is the buffer of the returned container: the traces are neither sent back nor concatenated.
+    """
+
+    def __init__(self, arch, alg, key_length, nonce_length, sca=True, workers=None):
+        """
+        :param arch: x86 or x64, the emulator wrapper of the workers
+        :param alg: the name of the algorithm (see EmulatorWrapper)
+        :param workers: the number of worker processes (by default: number of cores)
+        """
+        self.workers = workers if workers is not None else multiprocessing.cpu_count()
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                        initargs=(arch, alg, key_length, nonce_length, sca))
+
+    def capture(self, capture, key, n_samples, *args, seed=None, shard_size=100, on_shard=None):
+        """
+        Captures n_samples traces
+        :param capture: a module level function capture(wrapper, key, n_samples, rng, out, *args) that emulates n_samples
+            traces with the random generator rng, and returns the traces and their (structured) values. The traces must
+            be written to out(samples), the (n_samples, samples) rows of the shard in the buffer of the capture
+        :param seed: the seed of the capture (None for a random one)
+        :param shard_size: the number of traces emulated by a worker at once
+        :param on_shard: called with the traces and values of each shard, in order. If it returns True, the capture
+            stops early (see WrappedChipWhisperer.capture_traces)
+        :return: a TraceBatchContainer with the traces of all the shards, in order
+        """
+        if n_samples <= 0:
+            raise ValueError("at least one trace must be captured")
+
+        starts = range(0, n_samples, shard_size)
+        sizes = [min(shard_size, n_samples - start) for start in starts]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+        directory = tempfile.mkdtemp(prefix='emu_farm')
+        traces_file = (os.path.join(directory, 'traces.f32'), n_samples)
+        futures = [self.pool.submit(_capture_shard, capture, key, size, s, traces_file, start, args)
+                   for start, size, s in zip(starts, sizes, seeds)]
+
+        traces, values, count = None, [], 0
+        try:
+            for future, start, size in zip(tqdm(futures, desc='Emulating traces', unit='shard'), starts, sizes):
+                shard_values, samples = future.result()
+                if traces is None:
+                    traces = _map_traces(traces_file[0], n_samples, samples)
+
+                values.append(shard_values)
+                count = start + size
+
+                if on_shard is not None and on_shard(traces[start:count], shard_values):
+                    print("Stopping the capture early, after", count, "traces")
+                    break
+        finally:
+            # the remaining shards are not needed once the capture stops early or a shard fails
+            for f in futures:
+                f.cancel()
+            # the mapping stays valid once the file is removed (on POSIX systems)
+            shutil.rmtree(directory, ignore_errors=True)
+
+        return TraceBatchContainer(traces[:count], np.concatenate(values), copy=0)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+_farms = {}
+
+
+def shared_farm(arch, alg, key_length, nonce_length, sca=True, workers=None):
+    """Returns a persistent farm for the given emulator, created on first use and reused by later captures"""
+    key = (arch, alg, key_length, nonce_length, sca, workers)
+    if key not in _farms:
+        _farms[key] = EmulatorFarm(arch, alg, key_length, nonce_length, sca, workers)
+    return _farms[key]
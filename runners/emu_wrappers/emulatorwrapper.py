@@ -1,24 +1,107 @@
 from abc import ABC, abstractmethod
+from array import array
 from math import ceil
-from typing import Union
+from typing import Union, NamedTuple, Any
 
+import numpy as np
 from rainbow import rainbowBase
+from unicorn import UC_PROT_WRITE
 
 import util
 
 
+# Granularity of the memory restored by EmulatorWrapper.restore (unicorn maps memory by pages of 4 KiB)
+PAGE_SIZE = 0x1000
+
+# Hamming weight of every 16 bits value
+HW_16 = np.array([bin(i).count('1') for i in range(1 << 16)], np.uint8)
+
+
+def hamming_weights(values, out=None):
+    """
+    Computes the hamming weights of register values (up to 64 bits) with HW_16
+    :param values: a sequence of values, e.g. rainbow's sca_values_trace
+    :param out: the float32 array the weights are written to (by default a new one)
+    """
+    values = np.asarray(values, np.uint64)
+    if out is None:
+        out = np.empty(len(values), np.float32)
+
+    mask = np.uint64(0xffff)
+    out[:] = HW_16[values & mask]
+    for shift in (16, 32, 48):
+        out += HW_16[(values >> np.uint64(shift)) & mask]
+
+    return out
+
+
+class TraceRecorder:
+    """
+    Stands in for the list of values recorded by rainbow (sca_values_trace): the hooks of rainbow append each value,
+    which is written to a preallocated array of unsigned 64 bits integers at an index counter. The array is reused by
+    the next encryptions (see reset), and only replaced by a larger one when an encryption records more values than it
+    holds.
+    """
+
+    __slots__ = ('buffer', 'count')
+
+    def __init__(self, size=0):
+        self.buffer = array('Q', bytes(8 * max(size, 1024)))
+        self.count = 0
+
+    def append(self, value):
+        if self.count == len(self.buffer):
+            # a new array, the previous one may still be viewed by the traces of the last encryption
+            self.buffer = self.buffer + self.buffer
+        # unicorn gives the values of memory writes as signed integers, and vector loads can be wider than 64 bits
+        self.buffer[self.count] = value & 0xFFFFFFFFFFFFFFFF
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def reset(self, size=0):
+        """Empties the recorder, making sure that size values fit in the buffer"""
+        if len(self.buffer) < size:
+            self.buffer = array('Q', bytes(8 * size))
+        self.count = 0
+
+    def values(self) -> np.ndarray:
+        """The recorded values, as a uint64 view on the buffer"""
+        return np.frombuffer(self.buffer, np.uint64, count=self.count)
+
+
+class Snapshot(NamedTuple):
+    """State of an emulator in the middle of an encryption, see EmulatorWrapper.snapshot"""
+    address: int
+    context: Any
+    memory: list  # (address, uint8 array) of the writable regions
+
+
 class EmulatorWrapper(ABC):
     """
     Args:
         alg: the name of the algorithm to use (its runtime should be put in the `bin` directory)
     """
 
+    # Addresses of the arguments of crypto_aead_encrypt
+    MESSAGE_ADDR = 0xE0002000
+    AD_ADDR = 0xE0003000
+    CT_ADDR = 0xE0004000
+    CT_LEN_ADDR = 0xE0005000
+    NSEC_ADDR = 0xEA001000
+    NONCE_ADDR = NSEC_ADDR + 0x10
+    KEY_ADDR = NONCE_ADDR + 0x10
+
     def __init__(self, alg, key_length: int, nonce_length: int, nsec_length: int = 0, sca: bool = False):
         self.alg = alg
         self.key_length = key_length
         self.nonce_length = nonce_length
         self.nsec_length = nsec_length
         self.sca = sca
+        self.trace_window = None
+        # recorder of the values trace, reused by all the encryptions (see _trace_reset)
+        self._values = TraceRecorder()
 
     def to_bytes(self, msg: Union[str, bytes, int], size=None) -> bytes:
         return util.to_bytes(msg, size)
@@ -32,6 +115,152 @@ class EmulatorWrapper(ABC):
     def set_trace_regs(self, trace: bool):
         self.emulator().trace_regs = trace
 
+    def set_trace_window(self, start: Union[int, str, None] = None, stop: Union[int, str, None] = None):
+        """
+        Restricts the traces of the encryptions to a window of code. The encryption is emulated without tracing up to
+        the first execution of start, then with the enabled traces up to the first execution of stop, where the
+        emulation stops (the ciphertext is then not computed). The cnt of encrypt counts from start. The encryptions
+        raise a RuntimeError if start is never executed.
+
+        :param start: a code address or function name (None to trace from the beginning)
+        :param stop: a code address or function name (None to trace until the end)
+        """
+        self.trace_window = (start, stop) if start is not None or stop is not None else None
+
+    def _run(self, begin: int, cnt: int = 0):
+        """Emulates from begin, with the traces gated by the trace window"""
+        e = self.emulator()
+        if self.trace_window is None:
+            e.start(begin, 0, count=cnt)
+            return
+
+        start, stop = (e.functions[a] if isinstance(a, str) else a for a in self.trace_window)
+
+        if start is not None and start != begin:
+            enabled = e.trace, e.mem_trace, e.trace_regs
+            e.trace, e.mem_trace, e.trace_regs = False, False, False
+            try:
+                self._start_until(begin, start)
+            finally:
+                e.trace, e.mem_trace, e.trace_regs = enabled
+            begin = start
+
+        e.start(begin, self._stop_at(stop) if stop is not None else 0, count=cnt)
+
+    def _stop_at(self, address: int) -> int:
+        """
+        Returns the address for the next run to stop at. Unicorn 2 only checks it when it translates the code: the
+        translation of an earlier run (with another stop address) is dropped, else the run would not stop there
+        """
+        uc = self.emulator().emu
+        if address and hasattr(uc, 'ctl_remove_cache'):
+            uc.ctl_remove_cache(address, address + 1)
+        return address
+
+    def _start_until(self, begin: int, address: int):
+        """Emulates from begin up to the first execution of address, raises a RuntimeError if it is not reached"""
+        e = self.emulator()
+        if e.start(begin, self._stop_at(address)) or e.emu.reg_read(e.pc) != address:
+            raise RuntimeError(f"the emulation from {begin:#x} did not reach {address:#x}")
+
+    def leakage(self, values, start_at=0, out=None):
+        """
+        Converts the values recorded during an encryption (see encrypt) to a hamming weight leakage
+        :param start_at: the first recorded value to keep
+        :param out: the float32 array to write the leakage to, e.g. a row of a (traces, samples) buffer. If the
+            encryption recorded fewer values, the end of out is set to 0
+        """
+        if out is None:
+            return hamming_weights(values[start_at:])
+
+        values = values[start_at:start_at + len(out)]
+        hamming_weights(values, out[:len(values)])
+        out[len(values):] = 0
+        return out
+
+    def snapshot(self, address: Union[int, str], message: Union[str, bytes], associated_data: Union[str, bytes],
+                 key: Union[str, bytes, int], nonce: Union[str, bytes, int]) -> Snapshot:
+        """
+        Runs an encryption up to the given address and saves the CPU and memory state of the emulator.
+
+        Everything executed before the address must not depend on the nonce: encrypt_from_snapshot only patches the
+        nonce in memory before resuming.
+
+        :param address: a code address or the name of a function
+        """
+        e = self.emulator()
+        address = e.functions[address] if isinstance(address, str) else address
+
+        self._load_arguments(message, associated_data, key, nonce)
+        self._start_until(e.functions['crypto_aead_encrypt'], address)
+
+        uc = e.emu
+        memory = [(begin, np.frombuffer(bytes(uc.mem_read(begin, end - begin + 1)), np.uint8))
+                  for begin, end, perms in uc.mem_regions() if perms & UC_PROT_WRITE]
+        return Snapshot(address, uc.context_save(), memory)
+
+    def restore(self, snapshot: Snapshot):
+        """
+        Restores the CPU and memory state saved by snapshot.
+
+        Only the pages modified since the snapshot are written back (in practice the stack and data pages), the code is
+        never rewritten, which would also make unicorn discard its translations of the code.
+        """
+        uc = self.emulator().emu
+        for begin, data in snapshot.memory:
+            current = np.frombuffer(uc.mem_read(begin, len(data)), np.uint8)
+            dirty = (current != data).reshape(-1, PAGE_SIZE).any(axis=1)
+
+            for page in np.flatnonzero(dirty):
+                start = int(page) * PAGE_SIZE
+                uc.mem_write(begin + start, data[start:start + PAGE_SIZE].tobytes())
+        uc.context_restore(snapshot.context)
+
+    def encrypt_from_snapshot(self, snapshot: Snapshot, nonce: Union[str, bytes, int], cnt: int = 0) -> (int, bytes, [], []):
+        """
+        Same as encrypt, but resumes the encryption of a snapshot with another nonce. The traces only contain the
+        instructions executed after the address of the snapshot.
+        """
+        e = self.emulator()
+        self.restore(snapshot)
+        e[self.NONCE_ADDR] = self.to_bytes(nonce, self.nonce_length)
+
+        self._trace_reset(cnt)
+        self._run(snapshot.address, cnt)
+
+        return self._results(cnt)
+
+    def _trace_reset(self, cnt: int = 0):
+        """
+        Resets the traces of rainbow before an encryption, with the recorder in place of the list of values so that they
+        are recorded straight into a reused buffer (sized for cnt entries). The address trace holds the disassembled
+        instructions (strings), it stays a list.
+        """
+        e = self.emulator()
+        e.trace_reset()
+
+        self._values.reset(cnt)
+        e.sca_values_trace = self._values
+
+    def _results(self, cnt: int = 0) -> (int, bytes, list, np.ndarray):
+        """
+        Reads the ciphertext and the traces of the last encryption.
+
+        The values are a view on the buffer of the recorder (see _trace_reset): they are overwritten by the next
+        encryption, and the memory used does not grow with the number of encryptions.
+        """
+        e = self.emulator()
+        ct_len = int.from_bytes(e[self.CT_LEN_ADDR:self.CT_LEN_ADDR + 8], 'little')
+        ct = e[self.CT_ADDR:self.CT_ADDR + ct_len]
+
+        return ct_len, ct, e.sca_address_trace, self._values.values()
+
+    @abstractmethod
+    def _load_arguments(self, message: Union[str, bytes], associated_data: Union[str, bytes],
+                        key: Union[str, bytes, int], nonce: Union[str, bytes, int]):
+        """Resets the emulator, then writes the arguments of crypto_aead_encrypt to its memory and registers"""
+        pass
+
     @abstractmethod
     def encrypt(self, message: Union[str, bytes], associated_data: Union[str, bytes], key: Union[str, bytes, int],
                 nonce: Union[str, bytes, int]) -> (int, bytes, [], []):
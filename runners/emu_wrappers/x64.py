@@ -18,6 +18,15 @@ class x64(EmulatorWrapper):
     def encrypt(self, _message: Union[str, bytes], _associated_data: Union[str, bytes], _key: Union[str, bytes, int],
                 _nonce: Union[str, bytes, int], cnt: int = 0) -> (int, bytes, [], []):
         e = self.emu
+        self._load_arguments(_message, _associated_data, _key, _nonce)
+
+        self._trace_reset(cnt)
+        self._run(e.functions['crypto_aead_encrypt'], cnt)
+
+        return self._results(cnt)
+
+    def _load_arguments(self, _message, _associated_data, _key, _nonce):
+        e = self.emu
         e.reset()
 
         # Parse args
@@ -27,13 +36,13 @@ class x64(EmulatorWrapper):
         nonce = self.to_bytes(_nonce, self.nonce_length)
 
         # Set addresses
-        message_addr = 0xE0002000
-        ad_addr = 0xE0003000
-        ct_addr = 0xE0004000
-        ct_len_addr = 0xE0005000
-        nsec_addr = 0xEA001000
-        nonce_addr = nsec_addr + 0x10
-        key_addr = nonce_addr + 0x10
+        message_addr = self.MESSAGE_ADDR
+        ad_addr = self.AD_ADDR
+        ct_addr = self.CT_ADDR
+        ct_len_addr = self.CT_LEN_ADDR
+        nsec_addr = self.NSEC_ADDR
+        nonce_addr = self.NONCE_ADDR
+        key_addr = self.KEY_ADDR
 
         e[message_addr] = message
         e[ad_addr] = associated_data
@@ -56,22 +65,6 @@ class x64(EmulatorWrapper):
         e[stack_address + 0x10] = nonce_addr.to_bytes(8, 'little')
         e[stack_address + 0x18] = key_addr.to_bytes(8, 'little')
 
-        e.start(e.functions['crypto_aead_encrypt'], 0, count=cnt)
-
-        ct_len = int.from_bytes(e[ct_len_addr:ct_len_addr + 8], 'little')
-
-        # print()
-        # print("key:", e[key_addr:key_addr+key_length].hex())
-        # print("nonce:", e[nonce_addr:nonce_addr+nonce_length].hex())
-        # print("ct_area:", e[ct_addr:ct_addr + 16])
-        # print("ct_len_area:", e[ct_len_addr:ct_len_addr + 16])
-        # print("ct_len:", ct_len)
-
-        ct = e[ct_addr:ct_addr+ct_len]
-
-        return ct_len, ct, e.sca_address_trace, e.sca_values_trace
-
-
     def emulator(self) -> rainbowBase:
         return self.emu
 
@@ -1,50 +1,146 @@
 import ctypes
 import os.path
+import threading
 import numpy as np
 import util
 
 
+# Number of key bytes read by the libraries whose key is longer than the 16 bytes given by the attacks. The keys are
+# padded with zeros to this length (the elephant160 patch library reads the 20 bytes of the initial state)
+KEY_BYTES = {
+    'bin/elephant160-patch.so': 20,
+}
+
+
 class NativeRunner:
 
-    def __init__(self, lib_path):
+    def __init__(self, lib_path, key_bytes=None):
+        """:param key_bytes: the number of key bytes read by the library, shorter keys are padded with zeros"""
+        self.key_bytes = key_bytes
         file_path = lib_path if os.path.exists(lib_path) else "../../" + lib_path
         self.lib = ctypes.CDLL(file_path)
 
+        # Bound function pointers for the batch API, with their argument types resolved once
+        self._encrypt = self.lib['crypto_aead_encrypt']
+        self._encrypt.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_ulonglong),
+                                  ctypes.c_char_p, ctypes.c_ulonglong,
+                                  ctypes.c_char_p, ctypes.c_ulonglong,
+                                  ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+        self._encrypt.restype = ctypes.c_int
+
+        self._decrypt = self.lib['crypto_aead_decrypt']
+        self._decrypt.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_ulonglong), ctypes.c_void_p,
+                                  ctypes.c_char_p, ctypes.c_ulonglong,
+                                  ctypes.c_char_p, ctypes.c_ulonglong,
+                                  ctypes.c_void_p, ctypes.c_void_p]
+        self._decrypt.restype = ctypes.c_int
+
+        # Optional entry point looping over the candidates natively (see Targets/batch.c)
+        self._encrypt_batch = getattr(self.lib, 'crypto_aead_encrypt_batch', None)
+        if self._encrypt_batch is not None:
+            self._encrypt_batch.argtypes = [ctypes.c_void_p, ctypes.c_ulonglong,
+                                            ctypes.c_char_p, ctypes.c_ulonglong,
+                                            ctypes.c_char_p, ctypes.c_ulonglong,
+                                            ctypes.c_void_p, ctypes.c_ulonglong,
+                                            ctypes.c_void_p, ctypes.c_ulonglong,
+                                            ctypes.c_ulonglong]
+            self._encrypt_batch.restype = None
+
+        self._ct_len = ctypes.c_ulonglong(0)
+        self._buffer = ctypes.create_string_buffer(256)  # output of encrypt and decrypt
+        self._ct_lengths = {}  # ciphertext length for each (plaintext length, ad length)
+        self._out = None
+
+    def encrypt_batch(self, keys, nonces, plaintext='', adata='', out=None):
+        """
+        Encrypts the same plaintext and associated data with many keys.
+
+        :param keys: a (n, key length) uint8 array
+        :param nonces: a (n, nonce length) uint8 array, or a single nonce used with all the keys
+        :param plaintext: the plaintext to encrypt
+        :param adata: the associated data
+        :param out: a (n, ciphertext length) uint8 array to write the ciphertexts to. If None, an internal buffer is
+            reused, and the returned array is overwritten by the next call.
+        :return: the (n, ciphertext length) uint8 array of the ciphertexts
+        """
+        keys = np.asarray(keys, np.uint8)
+        if self.key_bytes is not None and keys.shape[1] < self.key_bytes:
+            keys = np.pad(keys, ((0, 0), (0, self.key_bytes - keys.shape[1])))
+        keys = np.ascontiguousarray(keys)
+        nonces = np.ascontiguousarray(np.frombuffer(nonces, np.uint8) if type(nonces) is bytes else nonces, np.uint8)
+        pt, ad = util.to_bytes(plaintext), util.to_bytes(adata)
+        n = len(keys)
+
+        if nonces.ndim == 1:
+            # same nonce for all keys
+            nonce_stride = 0
+        else:
+            nonce_stride = nonces.strides[0]
+
+        if (len(pt), len(ad)) not in self._ct_lengths:
+            nonce = nonces if nonce_stride == 0 else nonces[0]
+            self._ct_lengths[(len(pt), len(ad))] = len(self.encrypt(keys[0].tobytes(), pt, nonce.tobytes(), ad))
+        ct_len = self._ct_lengths[(len(pt), len(ad))]
+
+        if out is None:
+            if self._out is None or self._out.shape[0] < n or self._out.shape[1] != ct_len:
+                self._out = np.empty((n, ct_len), np.uint8)
+            out = self._out[:n]
+
+        if self._encrypt_batch is not None:
+            self._encrypt_batch(out.ctypes.data, out.strides[0], pt, len(pt), ad, len(ad),
+                                nonces.ctypes.data, nonce_stride, keys.ctypes.data, keys.strides[0], n)
+        else:
+            ct_len_ptr = ctypes.byref(self._ct_len)
+            out_ptr, nonce_ptr, key_ptr = out.ctypes.data, nonces.ctypes.data, keys.ctypes.data
+
+            for i in range(n):
+                self._encrypt(out_ptr + i * out.strides[0], ct_len_ptr, pt, len(pt), ad, len(ad), None,
+                              nonce_ptr + i * nonce_stride, key_ptr + i * keys.strides[0])
+
+        return out
+
     def encrypt(self, key, plaintext, nonce=None, adata=''):
-        ct = ctypes.create_string_buffer(256)
-        ct_len = ctypes.c_ulonglong(0)
-        ct_len_ptr = ctypes.pointer(ct_len) # ctypes.create_string_buffer(16) # ulonglong
-        pt = ctypes.c_char_p(util.to_bytes(plaintext))
-        ad = ctypes.c_char_p(util.to_bytes(adata))
-        k = ctypes.c_char_p(util.to_bytes(key))
+        pt, ad = util.to_bytes(plaintext), util.to_bytes(adata)
         if nonce is None:
             nonce = np.random.randint(0, 256, 16, np.uint8).tobytes()
-        nonce = ctypes.c_char_p(util.to_bytes(nonce))
-        self.lib.crypto_aead_encrypt(ct, ct_len_ptr,
-                                pt, ctypes.c_ulonglong(len(plaintext)),
-                                ad, ctypes.c_ulonglong(len(adata)),
-                                ctypes.c_void_p(),
-                                nonce,
-                                key
-                                )
 
-        return ct.raw[:ct_len.value]
+        self._encrypt(self._buffer, ctypes.byref(self._ct_len), pt, len(pt), ad, len(ad), None,
+                      util.to_bytes(nonce), self._pad_key(key))
+
+        return self._buffer.raw[:self._ct_len.value]
 
     def decrypt(self, key, ciphertext, nonce, adata=''):
-        m = ctypes.create_string_buffer(256)
-        m_len = ctypes.c_ulonglong(0)
-        m_len_ptr = ctypes.pointer(m_len) # ctypes.create_string_buffer(16) # ulonglong
-        ct = ctypes.c_char_p(util.to_bytes(ciphertext))
-        ad = ctypes.c_char_p(util.to_bytes(adata))
-        k = ctypes.c_char_p(util.to_bytes(key))
+        ct, ad = util.to_bytes(ciphertext), util.to_bytes(adata)
         if nonce is None:
             nonce = np.random.randint(0, 256, 16, np.uint8).tobytes()
-        nonce = ctypes.c_char_p(util.to_bytes(nonce))
-        self.lib.crypto_aead_decrypt(m, m_len_ptr,
-                                     ctypes.c_void_p(),
-                                ct, ctypes.c_ulonglong(len(ciphertext)),
-                                ad, ctypes.c_ulonglong(len(adata)),
-                                nonce,
-                                key)
-
-        return m.raw[:m_len.value]
+
+        self._decrypt(self._buffer, ctypes.byref(self._ct_len), None, ct, len(ct), ad, len(ad),
+                      util.to_bytes(nonce), self._pad_key(key))
+
+        return self._buffer.raw[:self._ct_len.value]
+
+    def _pad_key(self, key):
+        key = util.to_bytes(key)
+        if self.key_bytes is not None and len(key) < self.key_bytes:
+            key += bytes(self.key_bytes - len(key))
+        return key
+
+
+# NativeRunners of the current process, by library path (see native_runner)
+_runners = {}
+_runners_lock = threading.Lock()
+
+
+def native_runner(lib_path) -> NativeRunner:
+    """
+    Returns the NativeRunner of a library, loaded on first use and reused by later calls in the same process (each
+    worker process has its own runners)
+    """
+    runner = _runners.get(lib_path)
+    if runner is None:
+        with _runners_lock:
+            if lib_path not in _runners:
+                _runners[lib_path] = NativeRunner(lib_path, KEY_BYTES.get(lib_path))
+            runner = _runners[lib_path]
+    return runner
@@ -0,0 +1,160 @@
+import atexit
+import itertools
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from runners.native import native_runner
+
+# NativeRunner of the current worker process, loaded once by _init_worker
+_runner = None
+# Position of the match found by the current search, shared with the workers (see ParallelVerifier.search)
+_stop_at = None
+
+# Value of the stop position while no candidate matched
+_NOT_FOUND = 2 ** 62
+# Number of candidates checked between two reads of the stop position
+STOP_CHECK_INTERVAL = 256
+
+
+def _init_worker(lib_path, stop_at):
+    global _runner, _stop_at
+    _runner = native_runner(lib_path) if lib_path is not None else None
+    _stop_at = stop_at
+
+
+def _check_chunk(check, chunk, offset, args):
+    """
+    Checks a chunk by slices of STOP_CHECK_INTERVAL candidates, and stops once a match was found before the next slice
+    :return: the index of the matching candidate in the chunk, or None
+    """
+    for start in range(0, len(chunk), STOP_CHECK_INTERVAL):
+        if offset + start > _stop_at.value:
+            return None
+
+        index = check(_runner, chunk[start:start + STOP_CHECK_INTERVAL], *args)
+        if index is not None:
+            return start + index
+    return None
+
+
+def match_ciphertext(runner, keys, plaintext, nonce, ciphertext, adata=''):
+    """
+    Checks a chunk of candidate keys against a known plaintext-ciphertext pair
+    :param runner: the NativeRunner of the worker
+    :param keys: a list of keys (as bytes)
+    :return: the index of the key that gives the expected ciphertext, or None
+    """
+    keys = np.frombuffer(b''.join(keys), np.uint8).reshape(len(keys), -1)
+    expected = np.frombuffer(ciphertext, np.uint8)
+    cts = runner.encrypt_batch(keys, nonce, plaintext, adata)
+
+    if cts.shape[1] != len(expected):
+        return None
+
+    matches = np.flatnonzero((cts == expected).all(axis=1))
+    return int(matches[0]) if len(matches) > 0 else None
+
+
+class ParallelVerifier:
+    """
+    Verifies a stream of key candidates on a persistent pool of processes, each with its own NativeRunner.
+
+    The candidates are sent to the workers by chunks, in the order of the stream. As soon as a worker finds a matching
+    candidate, its position is shared with the workers: the chunks after it are cancelled or stop at their next slice,
+    and the chunks before it are completed, so that the first match of the stream is returned.
+    """
+
+    def __init__(self, lib_path=None, workers=None):
+        """
+        :param lib_path: the native library loaded by each worker (None if the checks do not need one)
+        :param workers: the number of worker processes (by default: number of cores)
+        """
+        self.lib_path = lib_path
+        self.workers = workers if workers is not None else multiprocessing.cpu_count()
+        self.stop_at = multiprocessing.Value('q', _NOT_FOUND)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                        initargs=(lib_path, self.stop_at))
+
+    def search(self, candidates, check, *args, chunk_size=1024):
+        """
+        Runs check on the stream of candidates until a candidate matches
+        :param candidates: an iterable of candidates (must be picklable)
+        :param check: a module level function check(runner, chunk, *args), that returns the index of the matching
+            candidate in the chunk, or None
+        :param chunk_size: the number of candidates sent to a worker at once
+        :return: the first matching candidate of the stream (or None) and the number of candidates tested (up to the
+            matching one)
+        """
+        iterator = iter(candidates)
+        in_flight = {}
+        offset, tested = 0, 0
+        exhausted = False
+        found, found_at = None, None
+        start = time.perf_counter()
+        self.stop_at.value = _NOT_FOUND
+
+        while True:
+            # keep all the workers busy, until a match is found
+            while found is None and not exhausted and len(in_flight) < 2 * self.workers:
+                chunk = list(itertools.islice(iterator, chunk_size))
+                if len(chunk) == 0:
+                    exhausted = True
+                    break
+
+                in_flight[self.pool.submit(_check_chunk, check, chunk, offset, args)] = (offset, chunk)
+                offset += len(chunk)
+
+            # once a match is found, only the chunks before it can contain an earlier one
+            pending = [future for future, (chunk_offset, _) in in_flight.items()
+                       if found_at is None or chunk_offset < found_at]
+            if len(pending) == 0:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk_offset, chunk = in_flight.pop(future)
+                tested += len(chunk)
+                index = future.result()
+
+                if index is not None and (found_at is None or chunk_offset + index < found_at):
+                    found, found_at = chunk[index], chunk_offset + index
+                    self.stop_at.value = found_at
+                    for other, (other_offset, _) in in_flight.items():
+                        if other_offset > found_at:
+                            other.cancel()
+
+        # the chunks after the match stop at their next slice, wait for them so that the workers are free
+        wait(in_flight)
+
+        elapsed = time.perf_counter() - start
+        print(f"[-] Tested {tested} candidates in {elapsed:.2f}s ({tested / max(elapsed, 1e-9):.0f} candidates/s, "
+              f"{self.workers} workers)")
+
+        return found, (found_at + 1 if found is not None else tested)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+_verifiers = {}
+
+
+def shared_verifier(lib_path=None, workers=None):
+    """Returns a persistent verifier for the given library, created on first use and reused by later searches"""
+    key = (lib_path, workers)
+    if key not in _verifiers:
+        _verifiers[key] = ParallelVerifier(lib_path, workers)
+    return _verifiers[key]
+
+
+def close_shared_verifiers():
+    """Shuts down the pools of the verifiers returned by shared_verifier (called at exit)"""
+    for verifier in _verifiers.values():
+        verifier.close()
+    _verifiers.clear()
+
+
+atexit.register(close_shared_verifiers)
@@ -0,0 +1,23 @@
+import numpy as np
+
+from util.cpa import BinnedCpaEngine, correlate, xor_model_table
+
+HW = np.array([bin(v).count('1') for v in range(256)])
+
+
+def test_binned_engine_matches_correlate():
+    rng = np.random.default_rng(0)
+    inputs = rng.integers(0, 256, 1000)
+    leakages = rng.normal(0, 1, (1000, 20))
+    leakages[:, 7] += HW[inputs ^ 0x5a]
+
+    table = xor_model_table(HW)
+    engine = BinnedCpaEngine('cpa', lambda values: values, table)
+    # a few batches of different sizes, as in a capture
+    for start, stop in [(0, 300), (300, 301), (301, 1000)]:
+        engine.update(leakages[start:stop], inputs[start:stop])
+
+    result = engine.finalize()
+    assert result.shape == (256, 20)
+    assert np.allclose(result, correlate(table[:, inputs].T, leakages), atol=1e-9)
+    assert np.unravel_index(result.argmax(), result.shape) == (0x5a, 7)
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from attacks.elephant160 import classifiers as elephant160
+from attacks.elephant176 import classifiers as elephant176
+from attacks.elephant_generic.classifiers import DumboModel, JumboModel
+
+MODELS = [elephant160, elephant176, DumboModel(), JumboModel()]
+
+
+@pytest.mark.parametrize('model', MODELS, ids=['elephant160', 'elephant176', 'dumbo', 'jumbo'])
+@pytest.mark.parametrize('rounds', [1, 3, None])
+def test_batched_spongent_matches_the_scalar_one(model, rounds):
+    rounds = model.n_rounds if rounds is None else rounds
+    states = np.random.default_rng(rounds).integers(0, 256, (5, model.state_bits // 8), np.uint8)
+
+    forward = model.spongent_batch(states, rounds)
+    inverse = model.spongent_inverse_batch(states, rounds)
+    for state, f, i in zip(states, forward, inverse):
+        assert bytes(f) == model.spongent(bytes(state), rounds)
+        assert bytes(i) == bytes(model.spongent_inverse(list(state), rounds))
+
+    assert np.array_equal(model.spongent_inverse_batch(forward, rounds), states)
@@ -0,0 +1,51 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+pytest.importorskip('rainbow')
+
+from runners.emu_farm import EmulatorFarm
+from util.values import pack_values
+
+
+def _capture(wrapper, key, n_samples, rng, out, fail_at):
+    """Fake traces of random values, without emulation, the shards of fail_at traces fail"""
+    traces = out(4)
+    traces[:] = rng.integers(0, 1 << 10, (n_samples, 1))
+    if n_samples == fail_at:
+        raise RuntimeError("shard failed")
+    return traces, pack_values(nonce=np.zeros((n_samples, 16), np.uint8))
+
+
+@pytest.fixture(scope='module')
+def farm():
+    farm = EmulatorFarm('x86', 'romulusn', 16, 16, workers=2)
+    yield farm
+    farm.close()
+
+
+def _temp_dirs():
+    return {name for name in os.listdir(tempfile.gettempdir()) if name.startswith('emu_farm')}
+
+
+def test_capture_is_reproducible(farm):
+    before = _temp_dirs()
+    first = farm.capture(_capture, bytes(16), 250, None, seed=1)
+    second = farm.capture(_capture, bytes(16), 250, None, seed=1)
+
+    assert first.leakages.shape == (250, 4)
+    assert np.array_equal(first.leakages, second.leakages)
+    assert _temp_dirs() == before
+
+
+def test_failed_or_empty_capture(farm):
+    before = _temp_dirs()
+    with pytest.raises(RuntimeError):
+        # the first shard fails, before the traces file is mapped
+        farm.capture(_capture, bytes(16), 250, 100, seed=1)
+    with pytest.raises(ValueError):
+        farm.capture(_capture, bytes(16), 0, None)
+
+    assert _temp_dirs() == before
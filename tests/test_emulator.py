@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('rainbow')
+
+from runners.emu_wrappers.x86 import x86
+from runners.native import native_runner
+
+KEY = bytes(range(16))
+NONCE = bytes(range(16, 32))
+
+
+@pytest.fixture(scope='module')
+def wrapper():
+    wrapper = x86("romulusn", 16, 16, sca=True)
+    wrapper.set_trace(True)
+    wrapper.set_mem_trace(True)
+    wrapper.set_trace_regs(True)
+    return wrapper
+
+
+def test_emulated_encryption(wrapper):
+    ct_len, ct, addresses, values = wrapper.encrypt('', '', KEY, NONCE)
+
+    assert bytes(ct[:ct_len]) == native_runner("bin/romulusn.so").encrypt(KEY, '', NONCE)
+    assert len(values) > 0 and values.dtype == np.uint64
+    assert len(wrapper.leakage(values)) == len(values)
+
+
+def test_restored_snapshot_gives_the_same_traces(wrapper):
+    other = bytes(range(32, 48))
+
+    # the first encryption modifies the memory, which is restored for the second one
+    snapshot = wrapper.snapshot('nonce_encryption', '', '', KEY, NONCE)
+    wrapper.encrypt_from_snapshot(snapshot, NONCE)
+    ct_len, ct, _, values = wrapper.encrypt_from_snapshot(snapshot, other)
+    restored = bytes(ct[:ct_len]), values.copy()
+
+    ct_len, ct, _, values = wrapper.encrypt_from_snapshot(wrapper.snapshot('nonce_encryption', '', '', KEY, other), other)
+
+    assert restored[0] == bytes(ct[:ct_len]) == native_runner("bin/romulusn.so").encrypt(KEY, '', other)
+    assert np.array_equal(restored[1], values)
+
+
+def test_snapshot_address_must_be_reached(wrapper):
+    with pytest.raises(RuntimeError):
+        wrapper.snapshot('crypto_aead_decrypt', '', '', KEY, NONCE)
+
+
+def _windowed(wrapper, start, stop, encrypt):
+    wrapper.set_trace_window(start, stop)
+    try:
+        return encrypt()[3].copy()
+    finally:
+        wrapper.set_trace_window()
+
+
+def test_windowed_trace_is_a_slice_of_the_full_trace(wrapper):
+    encrypt = lambda: wrapper.encrypt('', '', KEY, NONCE)
+    full = _windowed(wrapper, None, 'skinny_128_384_plus_enc', encrypt)
+    windowed = _windowed(wrapper, 'nonce_encryption', 'skinny_128_384_plus_enc', encrypt)
+
+    assert 0 < len(windowed) < len(full)
+    assert np.array_equal(windowed, full[len(full) - len(windowed):])
+
+    # the same window, from a snapshot at its start
+    snapshot = wrapper.snapshot('nonce_encryption', '', '', KEY, NONCE)
+    from_snapshot = _windowed(wrapper, None, 'skinny_128_384_plus_enc',
+                              lambda: wrapper.encrypt_from_snapshot(snapshot, NONCE))
+    assert np.array_equal(windowed, from_snapshot)
+
+
+def test_window_start_must_be_reached(wrapper):
+    with pytest.raises(RuntimeError):
+        _windowed(wrapper, 'crypto_aead_decrypt', None, lambda: wrapper.encrypt('', '', KEY, NONCE))
@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+
+from util import file_utils
+from util.values import pack_values
+
+NONCES = np.arange(64, dtype=np.uint8).reshape(4, 16)
+
+
+def test_structured_values_round_trip(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    values = pack_values(nonce=NONCES, ad=np.zeros((4, 32), np.uint8))
+    file_utils.save('proj', bytes(16), values, np.zeros((4, 10)), b'', b'')
+
+    loaded = file_utils.load('proj')
+    assert loaded['key'] == bytes(16)
+    assert np.array_equal(loaded['inputs'], values)
+
+
+def test_legacy_object_values_are_converted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    legacy = np.empty((4, 2), object)
+    for i in range(4):
+        legacy[i] = [NONCES[i], bytes(range(i, i + 32))]
+    file_utils.save('proj', None, legacy, np.zeros((4, 10)), b'', b'')
+
+    values = file_utils.load('proj')['inputs']
+    assert np.array_equal(values['nonce'], NONCES)
+    assert bytes(values['ad'][2]) == bytes(range(2, 34))
+
+    # converted once, the file is then read without pickle
+    assert os.path.exists('projects/proj-pt.npy.legacy')
+    assert np.array_equal(np.load('projects/proj-pt.npy', allow_pickle=False), values)
@@ -0,0 +1,29 @@
+import numpy as np
+
+from attacks.elephant160.attack import _expected_mask, _verify_masks, inverse_verify_key
+from runners.cw_simulated import SimulatedChipWhisperer
+from runners.native import native_runner
+
+KEY = bytes(range(16))
+PT = bytes(range(16, 32))
+NONCE = bytes(range(12))
+
+
+def test_elephant160_simulated_board_and_verifier_agree():
+    runner = native_runner("bin/elephant160-patch.so")
+    ct = SimulatedChipWhisperer('elephant160v2').encrypt(KEY, PT, NONCE)
+
+    assert ct == runner.encrypt(KEY, PT, NONCE)
+    assert inverse_verify_key(_expected_mask(KEY), PT, NONCE, ct) == KEY
+
+    wrong = bytearray(_expected_mask(KEY))
+    wrong[0] ^= 1
+    assert _verify_masks(runner, [bytes(wrong), _expected_mask(KEY)], PT, NONCE, ct) == 1
+
+
+def test_elephant160_keys_are_padded():
+    runner = native_runner("bin/elephant160-patch.so")
+    keys = np.frombuffer(KEY * 2, np.uint8).reshape(2, 16)
+
+    assert runner.encrypt(KEY, PT, NONCE) == runner.encrypt(KEY + bytes(4), PT, NONCE)
+    assert runner.encrypt_batch(keys, NONCE, PT)[1].tobytes() == runner.encrypt(KEY, PT, NONCE)
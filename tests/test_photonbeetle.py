@@ -0,0 +1,74 @@
+import pickle
+
+import numpy as np
+import pytest
+from scipy.stats import multivariate_normal
+
+from attacks.photonbeetle.templates import Template, convert_pickled_template, load_template, save_template
+
+
+def _random_template(rng, num_pois=4, samples=100):
+    """A template with random POIs, means and (positive definite) covariances"""
+    models = []
+    for col in range(8):
+        models.append([])
+        for row in range(8):
+            pois = rng.choice(samples, num_pois, replace=False)
+            means = rng.normal(0, 1, (5, num_pois))
+            factors = rng.normal(0, 1, (5, num_pois, num_pois))
+            covs = factors @ np.swapaxes(factors, 1, 2) + np.eye(num_pois)
+            models[-1].append((pois, means, covs))
+
+    params = {'array_start': 0, 'array_end': samples, 'num_windows': 1, 'platform': 'CWLITEARM',
+              'executable': 'photonbeetle'}
+    return Template.from_models(params, models)
+
+
+def test_scorer_matches_scipy():
+    rng = np.random.default_rng(0)
+    template = _random_template(rng)
+    traces = rng.normal(0, 1, (10, 100))
+
+    for col in (0, 5):
+        scores = template.scorer(col).score(traces)
+        assert scores.shape == (10, 8, 5)
+        for row in range(8):
+            for hw in range(5):
+                expected = multivariate_normal(template.means[col, row, hw], template.covs[col, row, hw]).logpdf(
+                    traces[:, template.pois[col, row]])
+                assert np.allclose(scores[:, row, hw], expected)
+
+
+def test_template_file_round_trip(tmp_path):
+    template = _random_template(np.random.default_rng(1))
+    path = str(tmp_path / 'test.tpl')
+    save_template(path, template)
+
+    loaded = load_template(path)
+    assert loaded.params == template.params
+    for name in Template.ARRAYS:
+        array = getattr(loaded, name)
+        assert isinstance(array, np.memmap) and not array.flags.writeable
+        assert array.dtype == getattr(template, name).dtype
+        assert np.array_equal(array, getattr(template, name))
+
+    # the scores of a loaded template are those of the original one
+    traces = np.random.default_rng(2).normal(0, 1, (3, 100))
+    assert np.array_equal(loaded.scorer(3).score(traces), template.scorer(3).score(traces))
+
+
+def test_pickled_templates_are_converted(tmp_path):
+    template = _random_template(np.random.default_rng(3))
+    models = [[(template.pois[col, row], template.means[col, row], template.covs[col, row]) for row in range(8)]
+              for col in range(8)]
+    pickled, path = str(tmp_path / 'old.tpl'), str(tmp_path / 'new.tpl')
+    with open(pickled, 'wb') as f:
+        pickle.dump({'params': template.params, 'templates': models}, f)
+
+    with pytest.raises(ValueError):
+        load_template(pickled)
+
+    convert_pickled_template(pickled, path)
+    loaded = load_template(path)
+    for name in Template.ARRAYS:
+        assert np.allclose(getattr(loaded, name), getattr(template, name))
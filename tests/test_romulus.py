@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from attacks.romulus.attack import _EarlyStopping
+from attacks.romulus.classifiers import HW_SBOX, round_1_inputs, round_1_model, round_1_table, round_2_hypotheses, \
+    round_2_inputs, round_2_model, round_2_table
+from util.values import pack_values
+
+KEY = np.frombuffer(bytes(range(0x30, 0x40)), np.uint8)
+
+
+def _batch(rng, n, noise=0.5):
+    """Synthetic traces that leak the round 1 sboxes at samples 0-7 and the round 2 ones at samples 8-15"""
+    values = pack_values(nonce=rng.integers(0, 256, (n, 16), np.uint8), iv=rng.integers(0, 256, (n, 16), np.uint8))
+    leakages = rng.normal(0, noise, (n, 16))
+    for byte in range(8):
+        leakages[:, byte] += HW_SBOX[round_1_inputs(values, byte) ^ KEY[byte]]
+        inputs = round_2_inputs(values['nonce'], values['iv'], byte, KEY[:8])
+        leakages[:, 8 + byte] += round_2_table[KEY[8 + byte], inputs]
+    return leakages, values
+
+
+@pytest.mark.parametrize('index', range(8))
+def test_hypotheses_match_the_scalar_models(index):
+    rng = np.random.default_rng(index)
+    nonces = rng.integers(0, 256, (20, 16), np.uint8)
+    initials = rng.integers(0, 256, (20, 16), np.uint8)
+    guesses = [0, 1, 0x5a, 0xff]
+
+    round_1 = round_1_table[:, round_1_inputs(pack_values(nonce=nonces, iv=initials), index)].T
+    round_2 = round_2_hypotheses(nonces, initials, index, KEY[:8])
+    for t in range(len(nonces)):
+        for guess in guesses:
+            assert round_1[t, guess] == round_1_model((nonces[t], initials[t]), guess, index)
+            # the scalar model takes the key start as integers, as with the lascar engines
+            assert round_2[t, guess] == round_2_model((nonces[t], initials[t]), guess, index, KEY[:8].astype(np.int64))
+
+    inputs = round_2_inputs(nonces, initials, index, KEY[:8])
+    assert np.array_equal(round_2, round_2_table[:, inputs].T)
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_early_stopping_feeds_every_batch_to_round_2(seed):
+    rng = np.random.default_rng(seed)
+    stopping = _EarlyStopping(patience=3, threshold=0.2)
+
+    batches = 0
+    while not stopping(*_batch(rng, 50)):
+        batches += 1
+        assert batches < 100
+
+    assert stopping.key_start == KEY[:8].tobytes()
+    assert bytes(int(guess) for guess in stopping.round_2.best_guesses) == KEY[8:].tobytes()
+    # round 2 saw all the traces, not only those captured once round 1 was stable
+    for engine in stopping.round_2.engines:
+        assert engine._bin_counts.sum() == 50 * (batches + 1)
+
+
+class _ScriptedRound1:
+    """Stands for the round 1 engines, with a given stability and key start after each batch"""
+
+    def __init__(self, script):
+        self.script = iter(script)
+        self.best_guesses = None
+
+    def __call__(self, leakages, values):
+        stable, key_start = next(self.script)
+        self.best_guesses = list(key_start)
+        return stable
+
+
+def test_early_stopping_rebuilds_round_2_from_all_batches():
+    rng = np.random.default_rng(2)
+    wrong = bytes(8)
+    stopping = _EarlyStopping(patience=100, threshold=0)
+    # stable, unstable (the batch still goes to round 2), then other guesses and back, which rebuild round 2
+    stopping.round_1 = _ScriptedRound1([(False, wrong), (True, KEY[:8]), (False, KEY[:8]), (False, wrong),
+                                        (True, KEY[:8]), (True, KEY[:8])])
+
+    for batches in range(1, 7):
+        stopping(*_batch(rng, 20))
+        if stopping.round_2 is not None:
+            for engine in stopping.round_2.engines:
+                assert engine._bin_counts.sum() == 20 * batches
+
+    assert stopping.key_start == KEY[:8].tobytes()
@@ -0,0 +1,140 @@
+import numpy as np
+
+
+def xor_model_table(lut, guess_range=range(256)):
+    """
+    Builds the hypothesis table of a leakage model of the form lut[input_byte ^ guess]
+    :param lut: the 256 values of the model, indexed by the intermediate value
+    :param guess_range: the guesses to include in the table
+    :return: a (guesses, 256) array, table[g, v] is the hypothesis for guess g when the input byte is v
+    """
+    lut = np.asarray(lut)
+    return lut[np.bitwise_xor.outer(np.asarray(guess_range), np.arange(256))]
+
+
+def correlate(hypotheses, leakages):
+    """
+    Computes the correlation of each guess with each sample of the traces
+    :param hypotheses: a (traces, guesses) matrix of hypotheses
+    :param leakages: a (traces, samples) matrix of traces
+    :return: the (guesses, samples) correlation matrix, as returned by lascar.CpaEngine.finalize()
+    """
+    h = hypotheses - np.mean(hypotheses, axis=0)
+    x = leakages - np.mean(leakages, axis=0)
+
+    cov = h.T @ x
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.nan_to_num(cov / np.sqrt(np.outer(np.einsum('ij,ij->j', h, h), np.einsum('ij,ij->j', x, x))))
+
+
+class BinnedCpaEngine:
+    """
+    A CPA engine for leakage models that only depend on a single input byte per trace.
+
+    lascar.CpaEngine evaluates the model for every trace and every guess. Here, the traces are instead summed into 256
+    bins (one per value of the input byte), and the correlation rows of all the guesses are computed from these sums
+    with a single matrix product. finalize() returns the same matrix as lascar.CpaEngine.finalize().
+    """
+
+    def __init__(self, name, selection_function, model_table):
+        """
+        :param name: name of the engine
+        :param selection_function: maps the values of a batch of traces to the input byte of each trace
+        :param model_table: a (guesses, 256) array, model_table[g, v] is the hypothesis for guess g and input byte v
+        """
+        self.name = name
+        self.selection_function = selection_function
+        self.model_table = np.asarray(model_table, np.float64)
+
+        self._bin_counts = np.zeros(256, np.int64)
+        self._bin_sums = None
+        self._sum_x2 = None
+
+    def update(self, leakages, values):
+        """Accumulates a batch of traces and their values"""
+        leakages = np.asarray(leakages, np.float64)
+        inputs = np.asarray(self.selection_function(values)).astype(np.intp)
+
+        if self._bin_sums is None:
+            self._bin_sums = np.zeros((256, leakages.shape[1]))
+            self._sum_x2 = np.zeros(leakages.shape[1])
+
+        # Sort the traces by input byte, then sum each run of identical bytes
+        order = np.argsort(inputs, kind='stable')
+        bins, starts = np.unique(inputs[order], return_index=True)
+        self._bin_sums[bins] += np.add.reduceat(leakages[order], starts, axis=0)
+        self._bin_counts += np.bincount(inputs, minlength=256)
+        self._sum_x2 += np.einsum('ij,ij->j', leakages, leakages)
+
+    def finalize(self):
+        """Returns the (guesses, samples) correlation matrix"""
+        table = self.model_table
+        count = self._bin_counts.sum()
+
+        m_x = self._bin_sums.sum(axis=0) / count
+        v_x = self._sum_x2 / count - m_x ** 2
+        m_y = table @ self._bin_counts / count
+        v_y = (table ** 2) @ self._bin_counts / count - m_y ** 2
+        cov = table @ self._bin_sums / count - np.outer(m_y, m_x)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.nan_to_num(cov / np.sqrt(np.outer(v_y, v_x)))
+
+
+def run_engines(container, engines, batch_size=1000):
+    """
+    Feeds all the traces of a container to the given binned engines
+    :return: the finalized results of the engines, in the same order
+    """
+    leakages, values = container.leakages, container.values
+
+    for start in range(0, len(leakages), batch_size):
+        for engine in engines:
+            engine.update(leakages[start:start + batch_size], values[start:start + batch_size])
+
+    return [engine.finalize() for engine in engines]
+
+
+class EarlyStopping:
+    """
+    Online CPA used to stop a capture early: each captured batch is fed to the engines, and the capture can stop once
+    the best guess of every engine has been the same, with a correlation above its threshold, for `patience`
+    consecutive batches.
+    """
+
+    def __init__(self, engines, thresholds, patience=3):
+        """
+        :param engines: the engines (e.g. BinnedCpaEngine) of the bytes to recover
+        :param thresholds: the minimum correlation of the best guess of each engine
+        :param patience: the number of consecutive batches for which the best guesses must be stable
+        """
+        self.engines = engines
+        self.thresholds = thresholds
+        self.patience = patience
+
+        self._best_guesses = None
+        self._stable_for = 0
+
+    def __call__(self, leakages, values) -> bool:
+        """Accumulates a batch of traces, returns True if the capture can stop"""
+        best_guesses = []
+        above_thresholds = True
+
+        for engine, threshold in zip(self.engines, self.thresholds):
+            engine.update(leakages, values)
+            r_max = np.abs(engine.finalize()).max(1)
+            best_guesses.append(r_max.argmax())
+            above_thresholds &= r_max.max() >= threshold
+
+        if above_thresholds and best_guesses == self._best_guesses:
+            self._stable_for += 1
+        else:
+            self._stable_for = 0
+
+        self._best_guesses = best_guesses
+        return self._stable_for >= self.patience
+
+    @property
+    def best_guesses(self):
+        """The best guess of each engine after the last batch"""
+        return self._best_guesses
@@ -0,0 +1,43 @@
+import heapq
+
+import numpy as np
+
+
+def enumerate_keys(candidates, scores, limit=None):
+    """
+    Yields the combinations of candidates by decreasing joint score, the joint score being the sum of the scores of the
+    parts (e.g. correlations or log-likelihoods).
+
+    The enumeration is best-first over the ranks of the candidates: each combination of ranks has a single parent (the
+    combination where its last non-zero rank is decremented), so the heap holds at most one entry per part for each
+    combination that was yielded.
+
+    :param candidates: for each part of the key, the list of its candidate values
+    :param scores: for each part of the key, the scores of its candidates (higher is better)
+    :param limit: the maximum number of combinations to yield (None to enumerate all of them)
+    :return: a generator of tuples of candidate values
+    """
+    orders = [np.argsort(s, kind='stable')[::-1] for s in scores]
+    sorted_scores = [np.asarray(s, np.float64)[o] for s, o in zip(scores, orders)]
+    sorted_candidates = [[c[i] for i in o] for c, o in zip(candidates, orders)]
+
+    if any(len(c) == 0 for c in sorted_candidates):
+        return
+
+    def joint_score(ranks):
+        return sum(s[r] for s, r in zip(sorted_scores, ranks))
+
+    start = (0,) * len(sorted_candidates)
+    heap = [(-joint_score(start), start)]
+    count = 0
+
+    while len(heap) > 0 and (limit is None or count < limit):
+        _, ranks = heapq.heappop(heap)
+        yield tuple(c[r] for c, r in zip(sorted_candidates, ranks))
+        count += 1
+
+        last = max([i for i, r in enumerate(ranks) if r > 0], default=0)
+        for i in range(last, len(ranks)):
+            if ranks[i] + 1 < len(sorted_candidates[i]):
+                child = ranks[:i] + (ranks[i] + 1,) + ranks[i + 1:]
+                heapq.heappush(heap, (-joint_score(child), child))
@@ -1,12 +1,18 @@
 import os.path
 import numpy as np
 
+from util.values import from_objects
+
 
 def exists(name):
     return os.path.exists('./projects/' + name + ".proj")
 
 
 def save(name, key: bytes, plaintexts, traces, oracle_pt: bytes, oracle_ct: bytes):
+    """
+    Saves a project. The values of the traces (plaintexts) are expected to be a structured array (see util.values), it
+    is saved as is and can be loaded without pickle.
+    """
     print(f"Saving traces to project {name}")
 
     if not os.path.exists("./projects"):
@@ -25,11 +31,31 @@ def save(name, key: bytes, plaintexts, traces, oracle_pt: bytes, oracle_ct: byte
     np.save(f"projects/{name}-ct.npy", traces)
 
 
+def _load_values(path):
+    """
+    Loads the values of a project without pickle. Values saved as an object array (before they were structured) are
+    converted once: the file is rewritten with structured values, the original is kept as <path>.legacy
+    """
+    try:
+        return np.load(path, allow_pickle=False)
+    except ValueError:
+        pass
+
+    print(f"Converting the values of {path} from the legacy format (object array) to structured values")
+    # only loaded with pickle once, the converted file is read without it
+    values = from_objects(np.load(path, allow_pickle=True))
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, values)
+    os.replace(path, path + ".legacy")
+    os.replace(path + ".tmp", path)
+    return values
+
+
 def load(name, load_traces=True):
     if not os.path.exists(f"./projects/{name}.proj"):
         return None
 
-    pt = np.load(f"projects/{name}-pt.npy") if load_traces else []
+    pt = _load_values(f"projects/{name}-pt.npy") if load_traces else []
     ct = np.load(f"projects/{name}-ct.npy") if load_traces else []
     key, oracle_pt, oracle_ct = None, None, None
 
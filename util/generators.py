@@ -0,0 +1,131 @@
+from typing import Callable, NamedTuple, Optional
+
+import numpy as np
+
+from util.values import field, pack_values
+
+# Leakage models of the simulated targets (see runners/cw_simulated.py).
+#
+# A model leakage(key, values) computes the intermediate values targeted by an attack for a batch of encryptions, and
+# returns the positions where they leak (in samples from the trigger, as the offsets of the scope) and the (traces,
+# positions) leaked values. The positions follow the capture parameters used by the attacks, so that the traces of a
+# simulated target can be captured exactly like the ones of a board.
+
+
+def _nonces(values):
+    return field(values, 'nonce')
+
+
+def romulus_leakage(key, values):
+    """Hamming weights of the sbox outputs of round 1 (bytes 0 to 7) and round 2 (bytes 0 to 7) of Skinny"""
+    from attacks.romulus.classifiers import HW_SBOX, compute_initial_states, round_1_inputs, round_2_inputs
+    from attacks.romulus.constants import LFSR_TK3, NP_TWEAKEY_P
+
+    key = np.frombuffer(key, np.uint8)
+    nonces = _nonces(values)
+    ad = field(values, 'ad') if 'ad' in values.dtype.names else np.zeros((len(values), 32), np.uint8)
+    initials = compute_initial_states(ad)
+    inputs = pack_values(nonce=nonces, iv=initials)
+
+    leaks = np.empty((len(values), 16), np.float32)
+    for i in range(8):
+        leaks[:, i] = HW_SBOX[round_1_inputs(inputs, i) ^ key[i]]
+        leaks[:, 8 + i] = HW_SBOX[round_2_inputs(nonces, initials, i, key[:8]) ^ LFSR_TK3[key[NP_TWEAKEY_P[i]]]]
+
+    return np.concatenate([2000 + 100 * np.arange(8), 6000 + 100 * np.arange(8)]), leaks
+
+
+def _elephant_leakage(module, attack_point, key, values):
+    """
+    Hamming weights of the sbox outputs of the first round of the permutation of the second block of associated data
+    (masked with the second mask), as classifier_ad
+    """
+    state_bytes = module.state_bytes
+    first_ad_block_size = state_bytes - 12
+    mask = module.mask_lfsr_step(module.spongent(key + bytes(state_bytes - 16)))
+    ad = field(values, 'ad')[:, first_ad_block_size:first_ad_block_size + state_bytes]
+
+    leaks = np.empty((len(values), state_bytes), np.float32)
+    for i in range(state_bytes):
+        leaks[:, i] = module.classifier_ad_table(i)[mask[i], ad[:, i]]
+
+    return attack_point + 4000 + 50 * np.arange(state_bytes), leaks
+
+
+def elephant160_leakage(key, values):
+    from attacks.elephant160 import classifiers
+    return _elephant_leakage(classifiers, 974000, key, values)
+
+
+def elephant176_leakage(key, values):
+    from attacks.elephant176 import classifiers
+    return _elephant_leakage(classifiers, 987000, key, values)
+
+
+def _select_columns(values, col, nonce):
+    """Batched version of photonbeetle.classifier.select_column, on (traces, 16) big endian uint8 arrays"""
+    from attacks.photonbeetle.constants import StateSize
+
+    rs = 0 if nonce else 4
+    columns = np.zeros(len(values), np.int64)
+    for j in range(4):
+        # bit position of the nibble in the 128 bits element
+        bit = 128 - 32 * j - (4 + 4 * (((rs + col + j) % StateSize) ^ 1))
+        nibble = (values[:, 15 - bit // 8] >> (bit % 8)) & 0xf
+        columns |= nibble.astype(np.int64) << (12 - 4 * j)
+    return columns
+
+
+def photonbeetle_leakage(key, values):
+    """Hamming weights of the 64 nibbles of the state after the MixColumn of round 1, as compute_round_1"""
+    from attacks.photonbeetle.classifier import HW_4, _key_part, _mix_column_part
+
+    key = np.frombuffer(key, np.uint8).copy()
+    key[15] ^= 0x20  # constant of the initial state (see create_model)
+    keys = np.repeat(key[None], len(values), axis=0)
+    nonces = _nonces(values)
+
+    leaks = np.empty((len(values), 8, 8), np.float32)
+    for col in range(8):
+        leaks[:, col] = HW_4[_key_part(col)[_select_columns(keys, col, False)]
+                             ^ _mix_column_part(col, _select_columns(nonces, col, True), 0)]
+
+    return 2000 + 50 * np.arange(64), leaks.reshape(len(values), 64)
+
+
+def gift_leakage(key, values):
+    """Bits of the 4 words of the states of simulate_real_output_state, for the rounds 1 and 2 of the attack"""
+    from attacks.gift.classifier import simulate_output_states
+
+    key_schedule = np.array([(key[2 * i] << 8) | key[2 * i + 1] for i in range(8)], np.uint32)
+    states = simulate_output_states(_nonces(values), key_schedule)
+
+    bits = (states[:, :, :, None] >> np.arange(32, dtype=np.uint32)) & 1  # (traces, round, word, bit)
+    # the attack looks for the changes of each word between samples 5050 + 1050 * word and 6050 + 1050 * word of the
+    # windows starting at 93250 (round 1) and 160100 (round 2)
+    positions = np.array([93250, 160100])[:, None, None] + 5100 + 1050 * np.arange(4)[:, None] + 16 * np.arange(32)
+
+    return positions.reshape(-1), bits.reshape(len(values), -1).astype(np.float32)
+
+
+class SimulatedTarget(NamedTuple):
+    leakage: Callable  # see the models above
+    library: Optional[str]  # native library answering the encryptions (None if there is none)
+
+
+# Targets by prefix of the firmware name (see WrappedChipWhisperer)
+TARGETS = {
+    'romulusn': SimulatedTarget(romulus_leakage, 'bin/romulusn.so'),
+    'elephant160': SimulatedTarget(elephant160_leakage, 'bin/elephant160-patch.so'),
+    'elephant176': SimulatedTarget(elephant176_leakage, 'bin/elephant176-patch.so'),
+    'photonbeetle': SimulatedTarget(photonbeetle_leakage, 'bin/photon-beetle.so'),
+    'giftcofb': SimulatedTarget(gift_leakage, None),
+}
+
+
+def simulated_target(alg) -> SimulatedTarget:
+    """Returns the simulated target of a firmware, e.g. elephant160v2-o3"""
+    for prefix, target in TARGETS.items():
+        if alg.startswith(prefix):
+            return target
+    raise ValueError(f"no simulated target for {alg}, expected one of {list(TARGETS)}")
@@ -0,0 +1,58 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArrays:
+    """
+    Publishes numpy arrays once in shared memory, so that worker processes can read them without receiving a copy.
+
+    The handles (names, shapes and dtypes of the segments) are sent to the workers instead of the arrays, and the workers
+    get read-only views with attach(). close() must be called once the workers are done.
+    """
+
+    def __init__(self, **arrays):
+        self.segments = []
+        self.handles = {}
+
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=segment.buf)[...] = array
+
+            self.segments.append(segment)
+            self.handles[name] = (segment.name, array.shape, array.dtype.str)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        self.segments = []
+
+
+def _open_segment(name):
+    try:
+        # the segment is owned by the process that created it, it must not be tracked (and unlinked) by the workers
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13: the workers share the resource tracker of the main process, which already tracks the segment
+        return shared_memory.SharedMemory(name=name)
+
+
+def attach(handles):
+    """
+    Attaches to arrays published by SharedArrays
+    :param handles: SharedArrays.handles
+    :return: a dict of read-only arrays, and the segments (to keep open while the arrays are used, then close)
+    """
+    arrays, segments = {}, []
+
+    for name, (segment_name, shape, dtype) in handles.items():
+        segment = _open_segment(segment_name)
+        array = np.ndarray(shape, np.dtype(dtype), buffer=segment.buf)
+        array.flags.writeable = False
+
+        arrays[name] = array
+        segments.append(segment)
+
+    return arrays, segments
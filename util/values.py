@@ -0,0 +1,76 @@
+import numpy as np
+
+# Inputs of an encryption that can be stored alongside a trace, in this order
+FIELDS = ('nonce', 'iv', 'pt', 'ad')
+
+
+def values_dtype(**sizes):
+    """
+    Builds the structured dtype of the values of a set of traces
+    :param sizes: the size in bytes of each field (see FIELDS), e.g. values_dtype(nonce=16, ad=32)
+    :return: a dtype with one (size,) uint8 field per given input
+    """
+    for name in sizes:
+        if name not in FIELDS:
+            raise ValueError(f"unknown field {name}, expected one of {FIELDS}")
+
+    return np.dtype([(name, np.uint8, (sizes[name],)) for name in FIELDS if name in sizes])
+
+
+def pack_values(**columns):
+    """
+    Packs columns of inputs into a structured array (one record per trace)
+    :param columns: for each field, a (traces, size) array (or a list of byte arrays of the same size)
+    :return: the structured array of values
+    """
+    columns = {name: np.asarray(column, np.uint8) for name, column in columns.items()}
+    lengths = {len(column) for column in columns.values()}
+    if len(lengths) != 1:
+        raise ValueError("all the fields must have the same number of traces")
+
+    values = np.empty(lengths.pop(), values_dtype(**{name: column.shape[1] for name, column in columns.items()}))
+    for name, column in columns.items():
+        values[name] = column
+
+    return values
+
+
+def field(values, name):
+    """Returns a field of the values as a contiguous (traces, size) uint8 array, e.g. for numba models"""
+    return np.ascontiguousarray(values[name])
+
+
+def as_values(values, default='nonce'):
+    """
+    Converts the values of traces to the structured representation
+    :param values: structured values, or a plain (traces, size) array (e.g. from an old project)
+    :param default: the field of a plain array
+    """
+    values = np.asarray(values)
+    if values.dtype.names is not None:
+        return values
+
+    return pack_values(**{default: values})
+
+
+def from_objects(values):
+    """
+    Converts the values of a project saved before they were structured, an object array with one row of inputs per
+    trace: (nonce,), (nonce, ad) or (nonce, pt, ad), each being a byte array or bytes (see WrappedChipWhisperer)
+    :return: the structured array of values
+    """
+    rows = [list(row) if isinstance(row, (tuple, list)) or (isinstance(row, np.ndarray) and row.dtype == object)
+            else [row] for row in values]
+    names = {1: ('nonce',), 2: ('nonce', 'ad'), 3: ('nonce', 'pt', 'ad')}.get(len(rows[0]) if rows else 1)
+    if names is None or any(len(row) != len(names) for row in rows):
+        raise ValueError("unknown format of legacy values, expected rows of (nonce,), (nonce, ad) or (nonce, pt, ad)")
+
+    columns = {}
+    for i, name in enumerate(names):
+        column = [np.frombuffer(bytes(row[i]), np.uint8) if not isinstance(row[i], np.ndarray)
+                  else np.asarray(row[i], np.uint8) for row in rows]
+        if len({len(item) for item in column}) > 1:
+            raise ValueError(f"the legacy {name} values do not all have the same size")
+        columns[name] = np.array(column, np.uint8).reshape(len(rows), -1)
+
+    return pack_values(**columns)